@@ -5,6 +5,124 @@ from ctypes import c_ushort
 from ctypes import c_long
 from ctypes import c_ulong
 from time import sleep
+import threading
+import time
+
+import numpy as np
+
+
+def compensate_temperature(ut, calibration):
+    """
+    Compensazione della temperatura, senza stato
+    :param ut: valore non compensato della temperatura
+    :param calibration: coefficienti di BMP180.get_calibration_data()
+    :return: (temperatura in gradi C, B5 da passare a compensate_pression)
+    """
+    x1 = (ut - calibration['AC6']) * calibration['AC5'] / pow(2, 15)
+    x2 = calibration['MC'] * pow(2, 11) / (x1 + calibration['MD'])
+    b5 = x1 + x2
+    t = (b5 + 8) / pow(2, 4)
+    return float(t) / 10, b5
+
+
+def compensate_pression(up, b5, calibration, mode=0):
+    """
+    Compensazione della pressione, senza stato.
+    I quadrati sono calcolati come prodotti (x * x, arrotondamento esatto) e non con pow(), cosi' il risultato e'
+    identico bit a bit a quello di compensate_batch()
+    :param up: valore non compensato della pressione
+    :param b5: B5 della temperatura letta insieme alla pressione
+    :param calibration: coefficienti di BMP180.get_calibration_data()
+    :param mode: oversampling (0-3)
+    :return: pressione in Pa
+    """
+    c = calibration
+    b6 = b5 - 4000
+    b6_2 = b6 * b6
+
+    x1 = (c['B2'] * b6_2 / pow(2, 12)) / pow(2, 11)
+    x2 = c['AC2'] * b6 / pow(2, 11)
+    x3 = x1 + x2
+
+    b3 = ((int(c['AC1'] * 4 + x3) << mode) + 2) / 4
+
+    x1 = c['AC3'] * b6 / pow(2, 13)
+    x2 = (c['B1'] * b6_2 / pow(2, 12)) / pow(2, 16)
+    x3 = (x1 + x2 + 2) / 4
+
+    b4 = c['AC4'] * c_ulong(int(x3) + 32768).value / pow(2, 15)
+    b7 = c_ulong(up - int(b3)).value * (50000 >> mode)
+
+    if b7 < 0x80000000:
+        p = (b7 * 2) / b4
+    else:
+        p = (b7 / b4) * 2
+
+    x1 = p / pow(2, 8)
+    x1 = x1 * x1
+    x1 = (x1 * 3038) / pow(2, 16)
+    x2 = (-7357 * p) / pow(2, 16)
+
+    p = p + (x1 + x2 + 3791) / pow(2, 4)
+    return int(p)
+
+
+def compensate_batch(ut, up, calibration, mode=0):
+    """
+    Compensazione vettoriale (NumPy) di campioni grezzi registrati, identica bit a bit a
+    compensate_temperature() / compensate_pression()
+    :param ut: array dei valori UT
+    :param up: array dei valori UP, up[i] compensato con ut[i]
+    :param calibration: coefficienti di BMP180.get_calibration_data()
+    :param mode: oversampling usato per acquisire up (0-3)
+    :return: (temperature float64 in gradi C, pressioni int64 in Pa; object se ci sono letture non valide)
+    """
+    c = calibration
+    ut = np.asarray(ut, dtype=np.int64)
+    up = np.asarray(up, dtype=np.int64)
+
+    x1 = (ut - c['AC6']) * c['AC5'] / pow(2, 15)
+    x2 = c['MC'] * pow(2, 11) / (x1 + c['MD'])
+    b5 = x1 + x2
+    t = (b5 + 8) / pow(2, 4) / 10
+
+    b6 = b5 - 4000
+    b6_2 = b6 * b6
+
+    x1 = (c['B2'] * b6_2 / pow(2, 12)) / pow(2, 11)
+    x2 = c['AC2'] * b6 / pow(2, 11)
+    x3 = x1 + x2
+
+    b3 = ((np.trunc(c['AC1'] * 4 + x3).astype(np.int64) << mode) + 2) / 4
+
+    x1 = c['AC3'] * b6 / pow(2, 13)
+    x2 = (c['B1'] * b6_2 / pow(2, 12)) / pow(2, 16)
+    x3 = (x1 + x2 + 2) / 4
+
+    b4_int = np.trunc(x3).astype(np.int64) + 32768
+    b7_int = up - np.trunc(b3).astype(np.int64)
+    # c_ulong dei valori negativi: numeri enormi che solo gli interi Python rappresentano esattamente,
+    # questi campioni (letture non valide) seguono il percorso scalare
+    wrapped = (b4_int < 0) | (b7_int < 0)
+    b4_int = np.where(wrapped, 1, b4_int)
+    b7 = np.where(wrapped, 0, b7_int) * (50000 >> mode)
+
+    b4 = c['AC4'] * b4_int / pow(2, 15)
+    p = np.where(b7 < 0x80000000, (b7 * 2) / b4, (b7 / b4) * 2)
+
+    x1 = p / pow(2, 8)
+    x1 = x1 * x1
+    x1 = (x1 * 3038) / pow(2, 16)
+    x2 = (-7357 * p) / pow(2, 16)
+
+    p = np.trunc(p + (x1 + x2 + 3791) / pow(2, 4)).astype(np.int64)
+
+    if wrapped.any():
+        # i risultati possono superare int64
+        p = p.astype(object)
+        for i in np.flatnonzero(wrapped):
+            p[i] = compensate_pression(int(up[i]), float(b5[i]), calibration, mode)
+    return t, p
 
 
 class BMP180:
@@ -20,35 +138,33 @@ class BMP180:
     term stability.
 
     """
-    __oss = {'mode': 0, 'time': 0.045}
+    __oss = {'mode': 0, 'time': 0.0045}
 
     DEVICE_ADDRESS = 0x77
 
     __bus = None
 
-    __AC1 = c_short(408)
-    __AC2 = c_short(-72)
-    __AC3 = c_short(-14383)
-    __AC4 = c_ushort(32741)
-    __AC5 = c_ushort(32757)
-    __AC6 = c_ushort(23153)
-    __B1 = c_short(6190)
-    __B2 = c_short(4)
-    __B3 = 0
-    __B4 = 0
+    __AC1 = c_short(408).value
+    __AC2 = c_short(-72).value
+    __AC3 = c_short(-14383).value
+    __AC4 = c_ushort(32741).value
+    __AC5 = c_ushort(32757).value
+    __AC6 = c_ushort(23153).value
+    __B1 = c_short(6190).value
+    __B2 = c_short(4).value
     __B5 = 0
-    __B6 = 0
-    __B7 = 0
-    __MB = c_short(-32768)
-    __MC = c_short(-8711)
-    __MD = c_short(2868)
+    __MB = c_short(-32768).value
+    __MC = c_short(-8711).value
+    __MD = c_short(2868).value
     __test = False
 
-    # Modalita' di campionamento
-    ULTRA_LOW_POWER_MODE = {'mode': 0, 'time': 0.045}
-    STANDARD = {'mode': 1, 'time': 0.075}
-    HIGH_RESOLUTION = {'mode': 2, 'time': 0.135}
-    ULTRA_HIGH_RESOLUTION = {'mode': 3, 'time': 0.255}
+    # Modalita' di campionamento, tempi di conversione massimi da datasheet
+    ULTRA_LOW_POWER_MODE = {'mode': 0, 'time': 0.0045}
+    STANDARD = {'mode': 1, 'time': 0.0075}
+    HIGH_RESOLUTION = {'mode': 2, 'time': 0.0135}
+    ULTRA_HIGH_RESOLUTION = {'mode': 3, 'time': 0.0255}
+
+    TEMPERATURE_TIME = 0.0045
 
     def __init__(self, bus, test_mode=False):
         """
@@ -76,59 +192,84 @@ class BMP180:
     def set_mode(self, mode):
         self.__oss = mode
 
-    def __read_temperature(self):
-        ut = c_long(27898)
-        if not self.__test:
-            self.__bus.start_comunication(self.DEVICE_ADDRESS)
-            self.__bus.write_byte(0xF4, 0x2E)
-            sleep(0.45)
-            ut = c_long(self.__bus.read_word(0xF6)).value
-            self.__bus.stop_comunication()
-        x1 = (ut - self.__AC6) * self.__AC5 / pow(2, 15)
-        x2 = self.__MC * pow(2, 11) / (x1 + self.__MD)
-        self.__B5 = x1 + x2
-        t = (self.__B5 + 8) / pow(2, 4)
-        return float(t) / 10
+    def get_mode(self):
+        return self.__oss
 
-    def __read_pression(self):
-        up = c_long(23843).value
+    def start_temperature(self):
+        """
+        Avvia una conversione della temperatura e rilascia il bus
+        :return: secondi da attendere prima di read_raw_temperature()
+        """
         if not self.__test:
-            self.__bus.start_comunication(self.DEVICE_ADDRESS)
-            data = 0x34 + (self.__oss['mode'] << 6)
-            self.__bus.write_byte(0xF4, data)
-            sleep(self.__oss['time'])
-            __MBs = self.__bus.read_byte(0xf6)
-            lsb = self.__bus.read_byte(0xf7)
-            xlsb = self.__bus.read_byte(0xf8)
-            self.__bus.stop_comunication()
-            up = c_long((__MBs << 16) + (lsb << 8) + xlsb >> (8 - self.__oss['mode'])).value
+            with self.__bus.session(self.DEVICE_ADDRESS):
+                self.__bus.write_byte(0xF4, 0x2E)
+        return self.TEMPERATURE_TIME
 
-        self.__B6 = self.__B5 - 4000
+    def read_raw_temperature(self):
+        """
+        :return: UT, valore non compensato della temperatura
+        """
+        if self.__test:
+            return 27898
+        with self.__bus.session(self.DEVICE_ADDRESS):
+            return c_long(self.__bus.read_word(0xF6)).value
 
-        x1 = (self.__B2 * pow(self.__B6, 2) / pow(2, 12)) / pow(2, 11)
-        x2 = self.__AC2 * self.__B6 / pow(2, 11)
-        x3 = x1 + x2
+    def start_pression(self):
+        """
+        Avvia una conversione della pressione con la modalita' corrente e rilascia il bus
+        :return: secondi da attendere prima di read_raw_pression()
+        """
+        if not self.__test:
+            data = 0x34 + (self.__oss['mode'] << 6)
+            with self.__bus.session(self.DEVICE_ADDRESS):
+                self.__bus.write_byte(0xF4, data)
+        return self.__oss['time']
 
-        self.__B3 = ((int(self.__AC1 * 4 + x3) << self.__oss['mode']) + 2) / 4
+    def read_raw_pression(self):
+        """
+        :return: UP, valore non compensato della pressione
+        """
+        if self.__test:
+            return 23843
+        with self.__bus.session(self.DEVICE_ADDRESS):
+            msb, lsb, xlsb = self.__bus.read_block(0xF6, 3)
+        return c_long((msb << 16) + (lsb << 8) + xlsb >> (8 - self.__oss['mode'])).value
 
-        x1 = self.__AC3 * self.__B6 / pow(2, 13)
-        x2 = (self.__B1 * pow(self.__B6, 2) / pow(2, 12)) / pow(2, 16)
-        x3 = (x1 + x2 + 2) / 4
+    def get_calibration_data(self):
+        """
+        :return: dict dei coefficienti di calibrazione, per le funzioni compensate_*
+        """
+        return {'AC1': self.__AC1, 'AC2': self.__AC2, 'AC3': self.__AC3, 'AC4': self.__AC4, 'AC5': self.__AC5,
+                'AC6': self.__AC6, 'B1': self.__B1, 'B2': self.__B2, 'MB': self.__MB, 'MC': self.__MC,
+                'MD': self.__MD}
 
-        self.__B4 = self.__AC4 * c_ulong(int(x3) + 32768).value / pow(2, 15)
-        self.__B7 = c_ulong(up - int(self.__B3)).value * (50000 >> self.__oss['mode'])
+    def compute_temperature(self, ut):
+        """
+        Temperatura compensata, memorizza B5 per compute_pression()
+        :param ut: valore letto da read_raw_temperature()
+        :return: temperatura in gradi C
+        """
+        t, self.__B5 = compensate_temperature(ut, self.get_calibration_data())
+        return t
 
-        if self.__B7 < 0x80000000:
-            p = (self.__B7 * 2) / self.__B4
-        else:
-            p = (self.__B7 / self.__B4) * 2
+    def compute_pression(self, up, b5=None):
+        """
+        Pressione compensata
+        :param up: valore letto da read_raw_pression()
+        :param b5: B5 della temperatura, default quello dell'ultima compute_temperature()
+        :return: pressione in Pa
+        """
+        if b5 is None:
+            b5 = self.__B5
+        return compensate_pression(up, b5, self.get_calibration_data(), self.__oss['mode'])
 
-        x1 = pow(p / pow(2, 8), 2)
-        x1 = (x1 * 3038) / pow(2, 16)
-        x2 = (-7357 * p) / pow(2, 16)
+    def __read_temperature(self):
+        sleep(self.start_temperature())
+        return self.compute_temperature(self.read_raw_temperature())
 
-        p = p + (x1 + x2 + 3791) / pow(2, 4)
-        return int(p)
+    def __read_pression(self):
+        sleep(self.start_pression())
+        return self.compute_pression(self.read_raw_pression())
 
     def get_data(self):
         t = self.__read_temperature()
@@ -149,3 +290,79 @@ class BMP180:
         print('__MB: ' + repr(self.__MB))
         print('__MC: ' + repr(self.__MC))
         print('__MD: ' + repr(self.__MD))
+
+
+class BMP180Reader:
+    """
+    Lettura asincrona del BMP180: un thread avvia le conversioni, rilascia il bus durante l'attesa e raccoglie il
+    risultato quando e' pronto, alternando una lettura della temperatura ogni temperature_ratio letture della
+    pressione. L'ultimo campione e' disponibile con get_latest() senza bloccare.
+    """
+
+    def __init__(self, sensor, temperature_ratio=1):
+        """
+
+        :param sensor: BMP180
+        :param temperature_ratio: letture della pressione per ogni lettura della temperatura
+        """
+        self.__sensor = sensor
+        self.__ratio = max(1, int(temperature_ratio))
+        self.__latest = None
+        self.__thread = None
+        self.__running = False
+        self.__samples = 0
+        self.__started_at = None
+
+    def set_temperature_ratio(self, temperature_ratio):
+        self.__ratio = max(1, int(temperature_ratio))
+
+    def start(self):
+        if self.__thread is None:
+            self.__running = True
+            self.__thread = threading.Thread(target=self.__run, name='BMP180Reader', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        sensor = self.__sensor
+        self.__samples = 0
+        self.__started_at = time.monotonic()
+        t = None
+        pressions = 0
+        while self.__running:
+            if t is None or pressions >= self.__ratio:
+                sleep(sensor.start_temperature())
+                t = sensor.compute_temperature(sensor.read_raw_temperature())
+                pressions = 0
+            sleep(sensor.start_pression())
+            p = sensor.compute_pression(sensor.read_raw_pression())
+            pressions += 1
+            self.__samples += 1
+            # tupla immutabile: la lettura da altri thread non vede mai un campione a meta'
+            self.__latest = (time.monotonic(), t, p)
+
+    def get_latest(self):
+        """
+        :return: (timestamp, temperatura, pressione) dell'ultimo campione, None se non ancora disponibile
+        """
+        return self.__latest
+
+    def get_sample_rate(self):
+        """
+        :return: campioni di pressione al secondo dall'avvio
+        """
+        if self.__started_at is None or self.__latest is None:
+            return 0.0
+        return self.__samples / (self.__latest[0] - self.__started_at)
+
+    def get_max_sample_rate(self):
+        """
+        :return: campioni al secondo teorici per la modalita' e il rapporto correnti
+        """
+        period = self.__sensor.get_mode()['time'] + BMP180.TEMPERATURE_TIME / self.__ratio
+        return 1.0 / period
@@ -1,9 +1,12 @@
 import threading
-from ctypes import c_int16
+import time
+from contextlib import contextmanager
 
-from smbus import SMBus
-from threading import Condition
-from i2c.i2c_register_configuration import I2CRegisterConfiguration
+try:
+    from smbus2 import SMBus, i2c_msg
+except ImportError:
+    from smbus import SMBus
+    i2c_msg = None
 
 
 class I2CRegisterConfiguration:
@@ -33,41 +36,105 @@ class I2CRegisterConfiguration:
         return self._address
 
 
+class I2CBusState:
+    """
+    Stato condiviso da tutte le istanze di I2CBus aperte sullo stesso numero di bus
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.owner = None
+        # indirizzo e istante di inizio delle sessioni annidate del thread proprietario
+        self.sessions = []
+        self.stats = {}
+
+
 class I2CBus:
-    __cond = Condition()
-    __busy = False
-    __address = None
-    __bus = None
-    __thread_owner = None
+    SMBUS_BLOCK_MAX = 32
+    I2C_RDWR_BLOCK_MAX = 8192
+
+    __states = {}
+    __states_lock = threading.Lock()
 
     def __init__(self, bus):
         self.__bus = SMBus(bus)
+        with I2CBus.__states_lock:
+            if bus not in I2CBus.__states:
+                I2CBus.__states[bus] = I2CBusState()
+            self.__state = I2CBus.__states[bus]
 
     def __have_connection(self):
-        return self.__thread_owner == threading.current_thread()
+        return self.__state.owner == threading.current_thread()
 
-    def start_comunication(self, address):
-        self.__cond.acquire()
-        if self.__thread_owner is not None:
-            self.__cond.wait()
-        self.__thread_owner = threading.current_thread()
-        self.__address = address
+    @property
+    def __address(self):
+        if not self.__have_connection():
+            raise Exception('Nessuna comunicazione attiva sul bus per il thread corrente')
+        return self.__state.sessions[-1][0]
+
+    def start_comunication(self, address=None):
+        """
+        Apre una sessione sul bus, rientrante per il thread proprietario
+        :param address: indirizzo del dispositivo, None per riusare quello della sessione corrente
+        """
+        state = self.__state
+        t = time.monotonic()
+        state.lock.acquire()
+        now = time.monotonic()
+        if address is None and state.sessions:
+            address = state.sessions[-1][0]
+        state.owner = threading.current_thread()
+        state.sessions.append((address, now))
+        stats = self.__get_address_stats(address)
+        stats['sessions'] += 1
+        stats['wait_total'] += now - t
+        stats['wait_max'] = max(stats['wait_max'], now - t)
 
     def stop_comunication(self):
-        self.__address = None
-        self.__thread_owner = None
-        self.__cond.notify()
-        self.__cond.release()
+        state = self.__state
+        if not self.__have_connection():
+            raise Exception('Nessuna comunicazione attiva sul bus per il thread corrente')
+        address, start = state.sessions.pop()
+        hold = time.monotonic() - start
+        stats = self.__get_address_stats(address)
+        stats['hold_total'] += hold
+        stats['hold_max'] = max(stats['hold_max'], hold)
+        if not state.sessions:
+            state.owner = None
+        state.lock.release()
+
+    @contextmanager
+    def session(self, address=None):
+        """
+        Sessione come context manager: with bus.session(0x19): ...
+        :param address: indirizzo del dispositivo
+        """
+        self.start_comunication(address)
+        try:
+            yield self
+        finally:
+            self.stop_comunication()
+
+    def __get_address_stats(self, address):
+        stats = self.__state.stats
+        if address not in stats:
+            stats[address] = {'sessions': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'hold_total': 0.0,
+                              'hold_max': 0.0}
+        return stats[address]
+
+    def get_stats(self):
+        """
+        Statistiche per indirizzo: numero di sessioni, tempo di attesa del lock e tempo di possesso
+        :return: dict {indirizzo: {...}}
+        """
+        with self.__state.lock:
+            return dict((address, dict(stats)) for address, stats in self.__state.stats.items())
 
     def read_byte(self, address):
-        if not self.__have_connection():
-            self.start_comunication(self.__address)
         data = self.__bus.read_byte_data(self.__address, address)
         return data
 
     def read_word(self, base_address, flip=False):
-        if not self.__have_connection():
-            self.start_comunication(self.__address)
         h = self.read_byte(base_address)
         l = self.read_byte(base_address + 1)
         data = h << 8 | l
@@ -75,17 +142,37 @@ class I2CBus:
             data = l << 8 | h
         return data
 
+    def read_block(self, address, length):
+        """
+        Legge length registri consecutivi in una sola transazione
+        :param address: registro di partenza
+        :param length: numero di byte (max get_max_block_length())
+        :return: lista di byte
+        """
+        if length <= self.SMBUS_BLOCK_MAX:
+            return self.__bus.read_i2c_block_data(self.__address, address, length)
+        if i2c_msg is None:
+            raise Exception('Lettura di ' + str(length) + ' byte non supportata senza smbus2')
+        write = i2c_msg.write(self.__address, [address])
+        read = i2c_msg.read(self.__address, length)
+        self.__bus.i2c_rdwr(write, read)
+        return list(read)
+
+    def get_max_block_length(self):
+        """
+        :return: numero massimo di byte leggibili con una read_block
+        """
+        if i2c_msg is None:
+            return self.SMBUS_BLOCK_MAX
+        return self.I2C_RDWR_BLOCK_MAX
+
     def write_byte(self, address, data):
-        if not self.__have_connection():
-            self.start_comunication(self.__address)
         self.__bus.write_byte_data(self.__address, address, data)
 
     def get_configuration(self, conf, address=None):
         if not isinstance(conf, I2CRegisterConfiguration):
             raise Exception('Formato parametro conf non valido ' + str(type(conf)) + ' atteso '
                             + str(type(I2CRegisterConfiguration)))
-        if address is None:
-            address = self.__address
         self.start_comunication(address)
         data = self.read_byte(conf.get_address())
         conf.set_data(data)
@@ -96,8 +183,6 @@ class I2CBus:
         if not isinstance(conf, I2CRegisterConfiguration):
             raise Exception('Formato parametro conf non valido ' + str(type(conf)) + ' atteso '
                             + str(type(I2CRegisterConfiguration)))
-        if address is None:
-            address = self.__address
         self.start_comunication(address)
         self.write_byte(conf.get_address(), conf.get_data())
         self.stop_comunication()
@@ -1,5 +1,9 @@
 from i2c.i2c_bus import I2CRegisterConfiguration
 from ctypes import c_int16
+from collections import deque
+import time
+
+import numpy as np
 
 
 class CtrlReg1A(I2CRegisterConfiguration):
@@ -16,6 +20,12 @@ class CtrlReg1A(I2CRegisterConfiguration):
 
     LOW_POWER_MODE = 0x8
 
+    # frequenza di campionamento (Hz) per ogni valore di ODR, normal / low power mode
+    __DATA_RATES = {
+        0x1: (1, 1), 0x2: (10, 10), 0x3: (25, 25), 0x4: (50, 50), 0x5: (100, 100), 0x6: (200, 200),
+        0x7: (400, 400), 0x8: (None, 1620), 0x9: (1344, 5376)
+    }
+
     Z_AXIS_ENABLE = 0x4
     Y_AXIS_ENABLE = 0x2
     X_AXIS_ENABLE = 0x1
@@ -49,6 +59,17 @@ class CtrlReg1A(I2CRegisterConfiguration):
     def power_on(self):
         return self.get_data() >> 4 != self.__POWER_OFF
 
+    def get_data_rate(self):
+        """
+        :return: frequenza di campionamento in Hz, None se spento
+        """
+        rates = self.__DATA_RATES.get((self._data >> 4) & 0x0f)
+        if rates is None:
+            return None
+        if self._data & self.LOW_POWER_MODE:
+            return rates[1]
+        return rates[0]
+
     def x_enable(self):
         return self._data and self.X_AXIS_ENABLE
 
@@ -95,6 +116,93 @@ class CtrlReg1A(I2CRegisterConfiguration):
         return strout
 
 
+class CtrlReg3A(I2CRegisterConfiguration):
+    REGISTER_ADDRESS = 0x22
+
+    I1_CLICK = 0x80
+    I1_AOI1 = 0x40
+    I1_AOI2 = 0x20
+    I1_DRDY1 = 0x10
+    I1_DRDY2 = 0x08
+    I1_WTM = 0x04
+    I1_OVERRUN = 0x02
+
+    def __init__(self, interrupts=0x00):
+        super(CtrlReg3A, self).__init__(self.REGISTER_ADDRESS, interrupts)
+
+    def __str__(self):
+        strout = '(' + str(hex(self._data)) + ') INT1: ['
+        if self._data & self.I1_CLICK:
+            strout += 'click, '
+        if self._data & self.I1_AOI1:
+            strout += 'AOI1, '
+        if self._data & self.I1_AOI2:
+            strout += 'AOI2, '
+        if self._data & self.I1_DRDY1:
+            strout += 'DRDY1, '
+        if self._data & self.I1_DRDY2:
+            strout += 'DRDY2, '
+        if self._data & self.I1_WTM:
+            strout += 'FIFO watermark, '
+        if self._data & self.I1_OVERRUN:
+            strout += 'FIFO overrun, '
+        if self._data & 0xfe:
+            strout = strout[:-2]
+        return strout + ']'
+
+
+class CtrlReg5A(I2CRegisterConfiguration):
+    REGISTER_ADDRESS = 0x24
+
+    BOOT = 0x80
+    FIFO_ENABLE = 0x40
+
+    def __init__(self, fifo_enable=False):
+        data = 0
+        if fifo_enable:
+            data = self.FIFO_ENABLE
+        super(CtrlReg5A, self).__init__(self.REGISTER_ADDRESS, data)
+
+    def __str__(self):
+        strout = '(' + str(hex(self._data)) + ') '
+        if self._data & self.FIFO_ENABLE:
+            strout += 'FIFO enable'
+        else:
+            strout += 'FIFO disable'
+        return strout
+
+
+class FifoCtrlRegA(I2CRegisterConfiguration):
+    REGISTER_ADDRESS = 0x2e
+
+    BYPASS_MODE = 0x00
+    FIFO_MODE = 0x40
+    STREAM_MODE = 0x80
+    TRIGGER_MODE = 0xc0
+
+    def __init__(self, mode=0x00, threshold=0):
+        """
+
+        :param mode: modalita' della FIFO (BYPASS_MODE, FIFO_MODE, STREAM_MODE, TRIGGER_MODE)
+        :param threshold: soglia di watermark (0-31)
+        """
+        super(FifoCtrlRegA, self).__init__(self.REGISTER_ADDRESS, (mode & 0xc0) | (threshold & 0x1f))
+
+    def __str__(self):
+        strout = '(' + str(hex(self._data)) + ') '
+        mode = self._data & 0xc0
+        if mode == self.BYPASS_MODE:
+            strout += 'Bypass mode'
+        if mode == self.FIFO_MODE:
+            strout += 'FIFO mode'
+        if mode == self.STREAM_MODE:
+            strout += 'Stream mode'
+        if mode == self.TRIGGER_MODE:
+            strout += 'Trigger mode'
+        strout += ' watermark ' + str(self._data & 0x1f)
+        return strout
+
+
 class CraRegM(I2CRegisterConfiguration):
     __REGISTER_ADDRESS = 0x00
 
@@ -225,13 +333,20 @@ class LSM303DLHL:
 
     __OUT_STATUS = 0x27
 
+    # MSB del sub-address: auto incremento del registro (accelerometro)
+    __AUTO_INCREMENT = 0x80
+
     __OUT_XACC = 0x28
     __OUT_YACC = 0x2a
     __OUT_ZACC = 0x2c
 
+    __FIFO_SRC = 0x2f
+    __FIFO_SIZE = 32
+
+    # nell'LSM303DLHC l'ordine dei registri del magnetometro e' X, Z, Y
     __OUT_XMAG = 0x3
-    __OUT_YMAG = 0x5
-    __OUT_ZMAG = 0x7
+    __OUT_ZMAG = 0x5
+    __OUT_YMAG = 0x7
 
     __bus = None
     __ctrl_reg1_a = CtrlReg1A()
@@ -249,24 +364,217 @@ class LSM303DLHL:
         bus.save_configuration(self.__mr_reg_m, self.MAG_ADDRESS)
 
     def get_accelerometer_data(self):
-        out = [0, 0, 0]
+        return [0 if value is None else value for value in self.get_accelerometer_update()]
+
+    def get_accelerometer_update(self):
+        """
+        Come get_accelerometer_data(), ma gli assi senza un dato nuovo nel registro di stato valgono None invece di 0
+        :return: [x, y, z]
+        """
+        out = [None, None, None]
         if self.__ctrl_reg1_a.power_on():
-            self.__bus.start_comunication(self.ACC_ADDRESS)
-            status = self.__bus.read_byte(self.__OUT_STATUS)
+            with self.__bus.session(self.ACC_ADDRESS):
+                # registro di stato e i 3 assi in un'unica lettura burst
+                data = self.__bus.read_block(self.__OUT_STATUS | self.__AUTO_INCREMENT, 7)
+            status = data[0]
             if status & 0x01 and self.__ctrl_reg1_a.x_enable():
-                out[0] = c_int16(self.__bus.read_word(self.__OUT_XACC, True)).value
+                out[0] = c_int16(data[2] << 8 | data[1]).value
             if status & 0x02 and self.__ctrl_reg1_a.y_enable():
-                out[1] = c_int16(self.__bus.read_word(self.__OUT_YACC, True)).value
+                out[1] = c_int16(data[4] << 8 | data[3]).value
             if status & 0x04 and self.__ctrl_reg1_a.z_enable():
-                out[2] = c_int16(self.__bus.read_word(self.__OUT_ZACC, True)).value
-            self.__bus.stop_comunication()
+                out[2] = c_int16(data[6] << 8 | data[5]).value
         return out
 
+    def read_accelerometer_sample(self):
+        """
+        Legge x, y, z senza controllare il registro di stato (da usare quando il dato e' sicuramente
+        pronto, es. su interrupt DRDY)
+        :return: [x, y, z]
+        """
+        with self.__bus.session(self.ACC_ADDRESS):
+            data = self.__bus.read_block(self.__OUT_XACC | self.__AUTO_INCREMENT, 6)
+        return [c_int16(data[1] << 8 | data[0]).value,
+                c_int16(data[3] << 8 | data[2]).value,
+                c_int16(data[5] << 8 | data[4]).value]
+
+    def enable_data_ready_interrupt(self, enable=True):
+        """
+        Porta il segnale DRDY dell'accelerometro sul pin INT1
+        :param enable: False per disattivarlo
+        """
+        interrupts = CtrlReg3A.I1_DRDY1 if enable else 0x00
+        self.__bus.save_configuration(CtrlReg3A(interrupts), self.ACC_ADDRESS)
+
+    def get_data_rate(self):
+        return self.__ctrl_reg1_a.get_data_rate()
+
     def get_magnetic_data(self):
+        """
+        :return: [x, y, z], riordinati dai registri X, Z, Y
+        """
         out = [0, 0, 0]
-        self.__bus.start_comunication(self.MAG_ADDRESS)
-        out[0] = c_int16(self.__bus.read_word(self.__OUT_XMAG)).value
-        out[1] = c_int16(self.__bus.read_word(self.__OUT_YMAG)).value
-        out[2] = c_int16(self.__bus.read_word(self.__OUT_ZMAG)).value
-        self.__bus.stop_comunication()
+        with self.__bus.session(self.MAG_ADDRESS):
+            # il magnetometro incrementa il registro da solo
+            data = self.__bus.read_block(self.__OUT_XMAG, 6)
+        out[0] = c_int16(data[0] << 8 | data[1]).value
+        out[2] = c_int16(data[2] << 8 | data[3]).value
+        out[1] = c_int16(data[4] << 8 | data[5]).value
         return out
+
+    def start_stream(self, threshold=0):
+        """
+        Attiva la FIFO dell'accelerometro in stream mode: il sensore accumula fino a 32 campioni
+        che vengono letti in blocco da read_stream()
+        :param threshold: soglia di watermark (0-31)
+        """
+        with self.__bus.session(self.ACC_ADDRESS):
+            self.__bus.save_configuration(CtrlReg5A(True))
+            self.__bus.save_configuration(FifoCtrlRegA(FifoCtrlRegA.STREAM_MODE, threshold))
+
+    def stop_stream(self):
+        with self.__bus.session(self.ACC_ADDRESS):
+            self.__bus.save_configuration(FifoCtrlRegA(FifoCtrlRegA.BYPASS_MODE))
+            self.__bus.save_configuration(CtrlReg5A(False))
+
+    def read_stream(self):
+        """
+        Svuota la FIFO dell'accelerometro con letture burst.
+        I timestamp (time.monotonic) sono ricostruiti dalla frequenza di CtrlReg1A: l'ultimo campione
+        corrisponde all'istante della lettura.
+        :return: (timestamps, samples): array float64 (n,) e array int16 (n, 3) con x, y, z
+        """
+        with self.__bus.session(self.ACC_ADDRESS):
+            src = self.__bus.read_byte(self.__FIFO_SRC)
+            t = time.monotonic()
+            count = src & 0x1f
+            if src & 0x40:
+                # overrun: FIFO piena
+                count = self.__FIFO_SIZE
+            raw = bytearray()
+            # in modalita' FIFO il registro torna a OUT_X_L_A dopo OUT_Z_H_A
+            chunk = max(1, self.__bus.get_max_block_length() // 6)
+            left = count
+            while left > 0:
+                n = min(chunk, left)
+                raw += bytearray(self.__bus.read_block(self.__OUT_XACC | self.__AUTO_INCREMENT, 6 * n))
+                left -= n
+        samples = np.frombuffer(bytes(raw), dtype='<i2').reshape(count, 3)
+        rate = self.__ctrl_reg1_a.get_data_rate()
+        if rate is None:
+            timestamps = np.full(count, t)
+        else:
+            timestamps = t - np.arange(count - 1, -1, -1, dtype=np.float64) / rate
+        return timestamps, samples
+
+
+class DataReadyReader:
+    """
+    Acquisizione dell'accelerometro guidata dall'interrupt DRDY: il pin INT1 dell'LSM303DLHC collegato ad un
+    picar_4wd.pin.Pin (o qualsiasi oggetto con irq(handler, trigger, timestamped)) provoca una lettura per ogni
+    fronte, senza polling del registro di stato.
+
+    I tempi partono dal timestamp del fronte passato dal Pin (quello del kernel con il backend chardev, il
+    momento della callback con RPi.GPIO), in nanosecondi di time.monotonic_ns().
+    """
+
+    def __init__(self, sensor, pin, trigger, size=1024):
+        """
+
+        :param sensor: LSM303DLHL
+        :param pin: pin collegato a INT1, es. Pin('D2')
+        :param trigger: fronte che segnala il dato pronto, es. Pin.IRQ_RISING
+        :param size: numero massimo di campioni tenuti nel buffer
+        """
+        self.__sensor = sensor
+        self.__pin = pin
+        self.__trigger = trigger
+        self.__buffer = deque(maxlen=size)
+        self.__running = False
+        self.__irq_installed = False
+        self.__last_edge = None
+        self.__stats = {'edges': 0, 'dropped': 0, 'dispatch_total': 0.0, 'dispatch_max': 0.0,
+                        'latency_total': 0.0, 'latency_max': 0.0, 'interval_min': None, 'interval_max': 0.0}
+
+    def start(self):
+        self.__running = True
+        if not self.__irq_installed:
+            self.__pin.irq(self.__on_edge, self.__trigger, timestamped=True)
+            self.__irq_installed = True
+        self.__sensor.enable_data_ready_interrupt(True)
+        # un dato gia' pronto tiene alto INT1: lo si legge per ripartire con un fronte
+        self.__on_edge(None)
+
+    def stop(self):
+        self.__running = False
+        self.__sensor.enable_data_ready_interrupt(False)
+
+    def __on_edge(self, channel, timestamp=None):
+        if not self.__running:
+            return
+        called = time.monotonic()
+        # senza timestamp (la lettura iniziale di start()) il fronte e' adesso
+        edge = called if timestamp is None else timestamp / 1e9
+        sample = self.__sensor.read_accelerometer_sample()
+        latency = time.monotonic() - edge
+        dispatch = called - edge
+        stats = self.__stats
+        if len(self.__buffer) == self.__buffer.maxlen:
+            stats['dropped'] += 1
+        self.__buffer.append((edge, sample[0], sample[1], sample[2]))
+        stats['edges'] += 1
+        stats['dispatch_total'] += dispatch
+        stats['dispatch_max'] = max(stats['dispatch_max'], dispatch)
+        stats['latency_total'] += latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
+        if self.__last_edge is not None:
+            interval = edge - self.__last_edge
+            if stats['interval_min'] is None or interval < stats['interval_min']:
+                stats['interval_min'] = interval
+            stats['interval_max'] = max(stats['interval_max'], interval)
+        self.__last_edge = edge
+
+    def get_samples(self):
+        """
+        Svuota il buffer
+        :return: lista di (timestamp, x, y, z), timestamp da time.monotonic() al fronte
+        """
+        samples = []
+        while self.__buffer:
+            samples.append(self.__buffer.popleft())
+        return samples
+
+    def get_stats(self):
+        """
+        :return: fronti ricevuti, campioni persi per buffer pieno, ritardo fronte -> callback (dispatch),
+                 latenza fronte -> dato letto e intervallo tra i fronti (da confrontare con 1 / data rate)
+        """
+        stats = dict(self.__stats)
+        stats['dispatch_avg'] = stats['dispatch_total'] / stats['edges'] if stats['edges'] else 0.0
+        stats['latency_avg'] = stats['latency_total'] / stats['edges'] if stats['edges'] else 0.0
+        stats['data_rate'] = self.__sensor.get_data_rate()
+        return stats
+
+
+class FakeEdgeSource:
+    """
+    Sorgente di fronti simulata, con la stessa interfaccia irq() di picar_4wd.pin.Pin
+    """
+
+    def __init__(self):
+        self.__handler = None
+        self.__timestamped = False
+
+    def irq(self, handler=None, trigger=None, timestamped=False):
+        self.__handler = handler
+        self.__timestamped = timestamped
+
+    def edge(self, channel=None, timestamp=None):
+        """
+        :param timestamp: istante del fronte in time.monotonic_ns(), None per adesso
+        """
+        if self.__handler is None:
+            return
+        if not self.__timestamped:
+            self.__handler(channel)
+            return
+        self.__handler(channel, time.monotonic_ns() if timestamp is None else timestamp)
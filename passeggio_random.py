@@ -3,9 +3,13 @@ import random
 import time
 
 import picar_4wd as fc
+from picar_4wd.ultrasonic import RangingService
 
 SCAN_SLEEP = 0.1
 MIN_DIST_FOLLOW = 30
+MAX_DIST = 200
+
+ranging = RangingService(fc.us, out_of_range=MAX_DIST)
 
 
 def lettura_media(angolo):
@@ -33,11 +37,25 @@ def scan_sx():
     return score
 
 
+def distanza_frontale():
+    # mediana delle ultime letture in background, senza attese
+    distanza = ranging.median(window=5)
+    while distanza is None:
+        time.sleep(ranging.period)
+        distanza = ranging.median(window=5)
+    return distanza
+
+
 def main_loop():
-    if lettura_media(0) > MIN_DIST_FOLLOW:
-        fc.forward(20)
-        while lettura_media(0) > MIN_DIST_FOLLOW:
-            pass
+    fc.servo.set_angle(0)
+    ranging.start()
+    try:
+        if distanza_frontale() > MIN_DIST_FOLLOW:
+            fc.forward(20)
+            while distanza_frontale() > MIN_DIST_FOLLOW:
+                time.sleep(ranging.period)
+    finally:
+        ranging.stop()
     fc.stop()
     lval = scan_sx()
     rval = scan_dx()
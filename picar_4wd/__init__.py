@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from picar_4wd.pwm import PWM
-from picar_4wd.adc import ADC
+from picar_4wd.adc import ADC, read_channels
 from picar_4wd.pin import Pin
-from picar_4wd.motor import Motor
-from picar_4wd.servo import Servo
+from picar_4wd.motor import Motor, DriveGroup, ramp_scheduler
+from picar_4wd.servo import Servo, sweep_order
 from picar_4wd.ultrasonic import Ultrasonic 
 from picar_4wd.speed import Speed
 from picar_4wd.filedb import FileDB  
+from picar_4wd.odometry import Odometry, compass_heading
+from picar_4wd.scanner import Scanner
+from picar_4wd.speed_control import SpeedController
 from picar_4wd.utils import *
 import time
 
@@ -20,17 +23,30 @@ right_rear_reverse = config.get('right_rear_reverse', default_value = False)
 
 ultrasonic_servo_offset = int(config.get('ultrasonic_servo_offset', default_value = 0)) 
 
+# Motor ramps (Motor.ramp): power/s and power/s^2
+ramp_scheduler.accel = config.get('motor_accel', default_value = ramp_scheduler.ACCEL)
+ramp_scheduler.jerk = config.get('motor_jerk', default_value = ramp_scheduler.JERK)
+
 # Init motors
 left_front = Motor(PWM("P13"), Pin("D4"), is_reversed=left_front_reverse) # motor 1
 right_front = Motor(PWM("P12"), Pin("D5"), is_reversed=right_front_reverse) # motor 2
 left_rear = Motor(PWM("P8"), Pin("D11"), is_reversed=left_rear_reverse) # motor 3
 right_rear = Motor(PWM("P9"), Pin("D15"), is_reversed=right_rear_reverse) # motor 4
+# the four wheels updated together, see drive.skew()
+drive = DriveGroup([left_front, right_front, left_rear, right_rear])
 
 # left_front_speed = Speed(12)
 # right_front_speed = Speed(16)
 left_rear_speed = Speed(25)
 right_rear_speed = Speed(4)  
 
+# Odometry, start() after start_speed_thread()
+odometry = Odometry(left_rear_speed, right_rear_speed, left_rear, right_rear)
+
+# Closed loop speed (cm/s) of each side, start() after start_speed_thread()
+speed_control = SpeedController([(left_rear_speed, [left_front, left_rear]),
+                                 (right_rear_speed, [right_front, right_rear])], db=config)
+
 # Init Greyscale
 gs0 = ADC('A5')
 gs1 = ADC('A6')
@@ -44,6 +60,9 @@ us = Ultrasonic(Pin('D8'), Pin('D9'))
 
 servo = Servo(PWM("P0"), offset=ultrasonic_servo_offset)
 
+# Sweeps into NumPy arrays, step() or start() it; scan_step below is the legacy one
+scanner = Scanner(servo, us)
+
 def start_speed_thread():
     # left_front_speed.start()
     # right_front_speed.start()
@@ -53,11 +72,7 @@ def start_speed_thread():
 ##################################################################
 # Grayscale 
 def get_grayscale_list():
-    adc_value_list = []
-    adc_value_list.append(gs0.read())
-    adc_value_list.append(gs1.read())
-    adc_value_list.append(gs2.read())
-    return adc_value_list
+    return read_channels([gs0, gs1, gs2])
 
 def is_on_edge(ref, gs_list):
     ref = int(ref)
@@ -116,7 +131,8 @@ def do(msg="", cmd=""):
 def get_distance_at(angle):
     global angle_distance
     servo.set_angle(angle)
-    time.sleep(0.04)
+    # only as long as the move needs, see Servo.settle_time
+    servo.wait()
     distance = us.get_distance()
     angle_distance = [angle, distance]
     return distance
@@ -153,37 +169,31 @@ def scan_step(ref):
     else:
         return False
 
+def scan(angles=range(-90, 91, STEP)):
+    # distance at each angle, in the order of angles; measured in the
+    # sweep order with the least servo travel from where it is now
+    distances = {}
+    for angle in sweep_order(angles, servo.position()):
+        distances[angle] = get_distance_at(angle)
+    return [distances[angle] for angle in angles]
+
 ########################################################
 # Motors
+# drive powers: left_front, right_front, left_rear, right_rear
 def forward(power):
-    left_front.set_power(power)
-    left_rear.set_power(power)
-    right_front.set_power(power)
-    right_rear.set_power(power)
+    drive.set_power(power, power, power, power)
 
 def backward(power):
-    left_front.set_power(-power)
-    left_rear.set_power(-power)
-    right_front.set_power(-power)
-    right_rear.set_power(-power)
+    drive.set_power(-power, -power, -power, -power)
 
 def turn_left(power):
-    left_front.set_power(-power)
-    left_rear.set_power(-power)
-    right_front.set_power(power)
-    right_rear.set_power(power)
+    drive.set_power(-power, power, -power, power)
 
 def turn_right(power):
-    left_front.set_power(power)
-    left_rear.set_power(power)
-    right_front.set_power(-power)
-    right_rear.set_power(-power)
+    drive.set_power(power, -power, power, -power)
 
 def stop():
-    left_front.set_power(0)
-    left_rear.set_power(0)
-    right_front.set_power(0)
-    right_rear.set_power(0)
+    drive.set_power(0, 0, 0, 0)
 
 def set_motor_power(motor, power):
     if motor == 1:
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 from picar_4wd.i2c import I2C
+from picar_4wd.i2c_executor import I2CExecutor
 
 class ADC(I2C):
     ADDR=0x14                   # i2c_address 0x14
+    PRIORITY = I2CExecutor.TELEMETRY
 
     def __init__(self, chn):    # adc channel:"A0, A1, A2, A3, A4, A5, A6, A7"
         super().__init__()
@@ -18,22 +20,26 @@ class ADC(I2C):
         self.reg = 0x40 + self.chn
         # self.bus = smbus.SMBus(1)
         
-    def read(self):                     
-        self.send([self.chn, 0, 0], self.ADDR)
-
-        # self._debug("Read from 0x%02X"%(self.ADDR))
-        # value_h = self.bus.read_byte(self.ADDR)
-        value_h = self.recv(1, self.ADDR)[0]            
-
-        # self._debug("Read from 0x%02X"%(self.ADDR))
-        # value_l = self.bus.read_byte(self.ADDR)
-        value_l = self.recv(1, self.ADDR)[0]           
-
+    def read(self):
+        # channel select and 2 bytes read in a single combined transaction
+        value_h, value_l = self._i2c_write_read(self.ADDR, [([self.chn, 0, 0], 2)])[0]
         value = (value_h << 8) + value_l
         # self._debug("Read value: %s"%value)
         return value
 
 
+def read_channels(channels):
+    """Read a snapshot of several ADC channels with a single bus transaction.
+
+    channels: list of ADC objects or channel names ("A0" - "A7")
+    """
+    adcs = [chn if isinstance(chn, ADC) else ADC(chn) for chn in channels]
+    if len(adcs) == 0:
+        return []
+    segments = [([adc.chn, 0, 0], 2) for adc in adcs]
+    results = adcs[0]._i2c_write_read(ADC.ADDR, segments)
+    return [(value_h << 8) + value_l for value_h, value_l in results]
+
 def test():
     import time
     adc = ADC(0)
@@ -0,0 +1,572 @@
+"""GPIO backends for Pin.
+
+RPiGPIOBackend wraps RPi.GPIO. CharDevBackend talks to the Linux GPIO
+character device (/dev/gpiochipN, uAPI v1 line handles and line events):
+several lines can be requested together and read or written with a single
+ioctl, and edge events carry the kernel timestamp. FakeChip is a pure
+Python chip with the same interface as GPIOChip, to exercise and benchmark
+CharDevBackend on any machine (python picar_4wd/gpio.py).
+
+This module does not import the rest of picar_4wd.
+"""
+import ctypes
+import errno
+import fcntl
+import functools
+import logging
+import os
+import select
+import threading
+import time
+
+# same values as RPi.GPIO, so Pin constants do not depend on the backend
+OUT = 0
+IN = 1
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+# linux/gpio.h, uAPI v1
+GPIOHANDLES_MAX = 64
+GPIOHANDLE_REQUEST_INPUT = 1 << 0
+GPIOHANDLE_REQUEST_OUTPUT = 1 << 1
+GPIOHANDLE_REQUEST_BIAS_PULL_UP = 1 << 5
+GPIOHANDLE_REQUEST_BIAS_PULL_DOWN = 1 << 6
+GPIOEVENT_REQUEST_RISING_EDGE = 1 << 0
+GPIOEVENT_REQUEST_FALLING_EDGE = 1 << 1
+GPIOEVENT_REQUEST_BOTH_EDGES = GPIOEVENT_REQUEST_RISING_EDGE | GPIOEVENT_REQUEST_FALLING_EDGE
+GPIOEVENT_EVENT_RISING_EDGE = 0x01
+GPIOEVENT_EVENT_FALLING_EDGE = 0x02
+
+
+class gpiohandle_request(ctypes.Structure):
+    _fields_ = [
+        ("lineoffsets", ctypes.c_uint32 * GPIOHANDLES_MAX),
+        ("flags", ctypes.c_uint32),
+        ("default_values", ctypes.c_uint8 * GPIOHANDLES_MAX),
+        ("consumer_label", ctypes.c_char * 32),
+        ("lines", ctypes.c_uint32),
+        ("fd", ctypes.c_int),
+    ]
+
+
+class gpiohandle_data(ctypes.Structure):
+    _fields_ = [("values", ctypes.c_uint8 * GPIOHANDLES_MAX)]
+
+
+class gpioevent_request(ctypes.Structure):
+    _fields_ = [
+        ("lineoffset", ctypes.c_uint32),
+        ("handleflags", ctypes.c_uint32),
+        ("eventflags", ctypes.c_uint32),
+        ("consumer_label", ctypes.c_char * 32),
+        ("fd", ctypes.c_int),
+    ]
+
+
+class gpioevent_data(ctypes.Structure):
+    _fields_ = [("timestamp", ctypes.c_uint64), ("id", ctypes.c_uint32)]
+
+
+def _IOWR(type, nr, struct):
+    return (3 << 30) | (ctypes.sizeof(struct) << 16) | (type << 8) | nr
+
+GPIO_GET_LINEHANDLE_IOCTL = _IOWR(0xB4, 0x03, gpiohandle_request)
+GPIO_GET_LINEEVENT_IOCTL = _IOWR(0xB4, 0x04, gpioevent_request)
+GPIOHANDLE_GET_LINE_VALUES_IOCTL = _IOWR(0xB4, 0x08, gpiohandle_data)
+GPIOHANDLE_SET_LINE_VALUES_IOCTL = _IOWR(0xB4, 0x09, gpiohandle_data)
+
+
+def _handle_flags(mode, pull=None):
+    if mode == OUT:
+        return GPIOHANDLE_REQUEST_OUTPUT
+    flags = GPIOHANDLE_REQUEST_INPUT
+    if pull == PUD_UP:
+        flags |= GPIOHANDLE_REQUEST_BIAS_PULL_UP
+    elif pull == PUD_DOWN:
+        flags |= GPIOHANDLE_REQUEST_BIAS_PULL_DOWN
+    return flags
+
+
+def _event_flags(trigger):
+    if trigger == RISING:
+        return GPIOEVENT_REQUEST_RISING_EDGE
+    if trigger == FALLING:
+        return GPIOEVENT_REQUEST_FALLING_EDGE
+    return GPIOEVENT_REQUEST_BOTH_EDGES
+
+
+def _read_event(fd):
+    # (timestamp ns, rising) of the next event queued on fd
+    data = os.read(fd, ctypes.sizeof(gpioevent_data))
+    event = gpioevent_data.from_buffer_copy(data)
+    return event.timestamp, event.id == GPIOEVENT_EVENT_RISING_EDGE
+
+
+########################################################
+# Chips
+
+class LineHandle(object):
+    # lines requested with GPIO_GET_LINEHANDLE_IOCTL (or the fd of a line event)
+    def __init__(self, fd, count):
+        self.fd = fd
+        self.count = count
+        self._data = gpiohandle_data()
+
+    def get_values(self):
+        fcntl.ioctl(self.fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, self._data)
+        return list(self._data.values[:self.count])
+
+    def set_values(self, values):
+        for i, value in enumerate(values):
+            self._data.values[i] = 1 if value else 0
+        fcntl.ioctl(self.fd, GPIOHANDLE_SET_LINE_VALUES_IOCTL, self._data)
+
+    def fileno(self):
+        return self.fd
+
+    def read_event(self):
+        return _read_event(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class GPIOChip(object):
+    """/dev/gpiochipN through the uAPI v1 ioctls."""
+
+    def __init__(self, path="/dev/gpiochip0"):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+
+    def request_lines(self, offsets, flags, default_values=None, consumer="picar-4wd"):
+        if len(offsets) > GPIOHANDLES_MAX:
+            raise ValueError("At most %s lines per request, not %s" % (GPIOHANDLES_MAX, len(offsets)))
+        request = gpiohandle_request()
+        for i, offset in enumerate(offsets):
+            request.lineoffsets[i] = offset
+            if default_values is not None:
+                request.default_values[i] = 1 if default_values[i] else 0
+        request.flags = flags
+        request.consumer_label = consumer.encode()[:31]
+        request.lines = len(offsets)
+        fcntl.ioctl(self.fd, GPIO_GET_LINEHANDLE_IOCTL, request)
+        return LineHandle(request.fd, len(offsets))
+
+    def request_event(self, offset, handle_flags, event_flags, consumer="picar-4wd"):
+        # the event fd also answers GPIOHANDLE_GET_LINE_VALUES_IOCTL. The
+        # timestamps are CLOCK_MONOTONIC since Linux 5.7 (realtime before)
+        request = gpioevent_request()
+        request.lineoffset = offset
+        request.handleflags = handle_flags
+        request.eventflags = event_flags
+        request.consumer_label = consumer.encode()[:31]
+        fcntl.ioctl(self.fd, GPIO_GET_LINEEVENT_IOCTL, request)
+        return LineHandle(request.fd, 1)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FakeLineHandle(object):
+    def __init__(self, chip, offsets, output, event_flags=0):
+        self.chip = chip
+        self.offsets = list(offsets)
+        self.count = len(offsets)
+        self.output = output
+        self.event_flags = event_flags
+        self._read_fd = None
+        self._write_fd = None
+        if event_flags:
+            # events are written in a pipe with the kernel layout, so the
+            # backend polls and reads them exactly like the real ones
+            self._read_fd, self._write_fd = os.pipe()
+
+    def get_values(self):
+        self.chip.calls += 1
+        return [self.chip.values[offset] for offset in self.offsets]
+
+    def set_values(self, values):
+        self.chip.calls += 1
+        if not self.output:
+            raise OSError(errno.EPERM, "Lines requested as input")
+        for offset, value in zip(self.offsets, values):
+            self.chip._set(offset, 1 if value else 0)
+
+    def fileno(self):
+        return self._read_fd
+
+    def read_event(self):
+        return _read_event(self._read_fd)
+
+    def _event(self, rising, timestamp):
+        wanted = GPIOEVENT_REQUEST_RISING_EDGE if rising else GPIOEVENT_REQUEST_FALLING_EDGE
+        if self.event_flags & wanted:
+            event = gpioevent_data(timestamp, GPIOEVENT_EVENT_RISING_EDGE if rising else GPIOEVENT_EVENT_FALLING_EDGE)
+            os.write(self._write_fd, bytes(event))
+
+    def close(self):
+        self.chip._release(self)
+        for fd in (self._read_fd, self._write_fd):
+            if fd is not None:
+                os.close(fd)
+        self._read_fd = self._write_fd = None
+
+
+class FakeChip(object):
+    """In memory GPIO chip with the GPIOChip interface.
+
+    set_input() drives a line from outside (an encoder, an echo pin) and
+    queues the edge events; wire() connects an output line to an input one.
+    calls counts the get/set operations, one per ioctl of a real chip.
+    """
+
+    def __init__(self, lines=54):
+        self.values = [0] * lines
+        self.flags = {}
+        self.calls = 0
+        self._owners = {}
+        self._wires = {}
+        self._lock = threading.Lock()
+
+    def request_lines(self, offsets, flags, default_values=None, consumer="picar-4wd"):
+        output = bool(flags & GPIOHANDLE_REQUEST_OUTPUT)
+        handle = FakeLineHandle(self, offsets, output)
+        self._own(handle)
+        for i, offset in enumerate(offsets):
+            if output:
+                self._set(offset, 1 if default_values is not None and default_values[i] else 0)
+            self._bias(offset, flags)
+        return handle
+
+    def request_event(self, offset, handle_flags, event_flags, consumer="picar-4wd"):
+        handle = FakeLineHandle(self, [offset], False, event_flags)
+        self._own(handle)
+        self._bias(offset, handle_flags)
+        return handle
+
+    def _bias(self, offset, flags):
+        # flags of the last request of each line, pulls applied to the inputs
+        self.flags[offset] = flags
+        if flags & GPIOHANDLE_REQUEST_OUTPUT:
+            return
+        if flags & GPIOHANDLE_REQUEST_BIAS_PULL_UP:
+            self._set(offset, 1)
+        elif flags & GPIOHANDLE_REQUEST_BIAS_PULL_DOWN:
+            self._set(offset, 0)
+
+    def set_input(self, offset, value, timestamp=None):
+        self._set(offset, 1 if value else 0, timestamp)
+
+    def wire(self, output, input):
+        self._wires[output] = input
+
+    def _own(self, handle):
+        with self._lock:
+            for offset in handle.offsets:
+                if offset in self._owners:
+                    handle.close()
+                    raise OSError(errno.EBUSY, "Line %s already requested" % offset)
+            for offset in handle.offsets:
+                self._owners[offset] = handle
+
+    def _release(self, handle):
+        with self._lock:
+            for offset in handle.offsets:
+                if self._owners.get(offset) is handle:
+                    del self._owners[offset]
+
+    def _set(self, offset, value, timestamp=None):
+        if self.values[offset] == value:
+            return
+        self.values[offset] = value
+        owner = self._owners.get(offset)
+        if owner is not None and owner.event_flags:
+            owner._event(value == 1, time.monotonic_ns() if timestamp is None else timestamp)
+        if offset in self._wires:
+            self._set(self._wires[offset], value, timestamp)
+
+    def close(self):
+        pass
+
+
+########################################################
+# Backends
+
+class RPiGPIOBackend(object):
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        # bound straight to the C functions, no extra call level
+        self.input = GPIO.input
+        self.output = GPIO.output
+
+    def setup(self, pin, mode, pull=None):
+        if pull is not None:
+            self.GPIO.setup(pin, mode, pull_up_down=pull)
+        else:
+            self.GPIO.setup(pin, mode)
+
+    def add_event_detect(self, pin, trigger, callback):
+        # callback(pin, timestamp_ns), stamped when the callback thread runs
+        def wrapper(channel):
+            callback(channel, time.monotonic_ns())
+        self.GPIO.add_event_detect(pin, trigger, callback=wrapper)
+
+    def remove_event_detect(self, pin):
+        self.GPIO.remove_event_detect(pin)
+
+    def request_lines(self, pins, mode, pull=None):
+        for pin in pins:
+            self.setup(pin, mode, pull)
+        return _PinLines(self, pins)
+
+
+class _PinLines(object):
+    # request_lines of the backends without bulk access: one call per line
+    def __init__(self, backend, pins):
+        self.backend = backend
+        self.pins = list(pins)
+
+    def get_values(self):
+        return [self.backend.input(pin) for pin in self.pins]
+
+    def set_values(self, values):
+        for pin, value in zip(self.pins, values):
+            self.backend.output(pin, value)
+
+
+class _GroupLines(object):
+    # lines of one chip request: the values of the outputs are cached, so a
+    # single line can be written through the group handle
+    def __init__(self, handle, pins, values):
+        self.handle = handle
+        self.pins = list(pins)
+        self.values = list(values)
+
+    def get_values(self):
+        return self.handle.get_values()
+
+    def set_values(self, values):
+        self.values = [1 if value else 0 for value in values]
+        self.handle.set_values(self.values)
+
+    def set_value(self, index, value):
+        self.values[index] = 1 if value else 0
+        self.handle.set_values(self.values)
+
+
+class CharDevBackend(object):
+    """Pin backend on a GPIO character device (GPIOChip or FakeChip).
+
+    Every line belongs to one request: setup() requests it alone,
+    request_lines() moves several lines into a shared request, and
+    add_event_detect() turns it into a line event. Edge callbacks run in one
+    thread polling all the event fds and get the kernel timestamp.
+    """
+
+    def __init__(self, chip="/dev/gpiochip0"):
+        self.chip = GPIOChip(chip) if isinstance(chip, str) else chip
+        self._lines = {}            # {pin: (_GroupLines or event handle, index)}
+        self._events = {}           # {fd: (pin, handle, callback)}
+        self._pulls = {}            # {pin: pull of the last setup}, applied to every request
+        self._lock = threading.RLock()
+        self._poll = None
+        self._thread = None
+        self._wake = None
+
+    def _release(self, pin):
+        # take the line out of its current request; the other lines of a
+        # shared request are requested again without it
+        entry = self._lines.pop(pin, None)
+        if entry is None:
+            return
+        lines, index = entry
+        if isinstance(lines, _GroupLines):
+            lines.handle.close()
+            others = [(p, v) for p, v in zip(lines.pins, lines.values) if p != pin]
+            if others:
+                for p, _ in others:
+                    del self._lines[p]
+                self._request([p for p, _ in others], OUT if lines.handle_output else IN,
+                              [v for _, v in others])
+        else:
+            self._remove_event(pin)
+
+    def _pull(self, pins):
+        # the bias flags are per request: the pull shared by all the pins, if any
+        pulls = set(self._pulls.get(pin) for pin in pins)
+        return pulls.pop() if len(pulls) == 1 else None
+
+    def _request(self, pins, mode, values=None):
+        if values is None:
+            values = [0] * len(pins)
+        handle = self.chip.request_lines(pins, _handle_flags(mode, self._pull(pins)), values)
+        lines = _GroupLines(handle, pins, values)
+        lines.handle_output = mode == OUT
+        for index, pin in enumerate(pins):
+            self._lines[pin] = (lines, index)
+        return lines
+
+    def setup(self, pin, mode, pull=None):
+        with self._lock:
+            self._pulls[pin] = pull
+            self._release(pin)
+            self._request([pin], mode)
+
+    def input(self, pin):
+        lines, index = self._lines[pin]
+        return lines.get_values()[index]
+
+    def output(self, pin, value):
+        lines, index = self._lines[pin]
+        lines.set_value(index, value)
+
+    def request_lines(self, pins, mode, pull=None):
+        # all the lines in one request: get_values/set_values are one ioctl
+        with self._lock:
+            values = []
+            for pin in pins:
+                entry = self._lines.get(pin)
+                values.append(entry[0].values[entry[1]] if entry is not None and isinstance(entry[0], _GroupLines) else 0)
+                self._release(pin)
+                if pull is not None:
+                    self._pulls[pin] = pull
+            return self._request(list(pins), mode, values)
+
+    def add_event_detect(self, pin, trigger, callback):
+        # callback(pin, timestamp_ns) with the kernel timestamp of the edge
+        with self._lock:
+            self._release(pin)
+            handle = self.chip.request_event(pin, _handle_flags(IN, self._pulls.get(pin)), _event_flags(trigger))
+            self._lines[pin] = (_EventLines(handle), 0)
+            self._events[handle.fileno()] = (pin, handle, callback)
+            self._start_events()
+            self._poll.register(handle.fileno(), select.POLLIN | select.POLLPRI)
+            os.write(self._wake[1], b"x")
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            entry = self._lines.get(pin)
+            if entry is None or not isinstance(entry[0], _EventLines):
+                return
+            self._release(pin)
+            self._request([pin], IN)
+
+    def _remove_event(self, pin):
+        for fd, (event_pin, handle, _) in list(self._events.items()):
+            if event_pin == pin:
+                del self._events[fd]
+                self._poll.unregister(fd)
+                os.write(self._wake[1], b"x")
+                handle.close()
+
+    def _start_events(self):
+        if self._thread is None:
+            self._poll = select.poll()
+            self._wake = os.pipe()
+            self._poll.register(self._wake[0], select.POLLIN)
+            self._thread = threading.Thread(target=self._run_events, name="gpio-events", daemon=True)
+            self._thread.start()
+
+    def _run_events(self):
+        while True:
+            for fd, _ in self._poll.poll():
+                if fd == self._wake[0]:
+                    os.read(fd, 64)
+                    continue
+                entry = self._events.get(fd)
+                if entry is None:
+                    continue
+                pin, handle, callback = entry
+                try:
+                    timestamp, _ = handle.read_event()
+                except OSError:
+                    # closed while the event was pending
+                    continue
+                try:
+                    callback(pin, timestamp)
+                except Exception as e:
+                    # like RPi.GPIO: one failing handler must not stop the
+                    # edges of every other pin
+                    logging.warning("GPIO%d edge callback failed: %s" % (pin, e))
+
+
+class _EventLines(object):
+    def __init__(self, handle):
+        self.handle = handle
+
+    def get_values(self):
+        return self.handle.get_values()
+
+    def set_value(self, index, value):
+        raise OSError(errno.EPERM, "Line requested for edge events")
+
+
+########################################################
+
+def benchmark(backend=None, pins=(23, 24, 13, 20), seconds=0.5):
+    # per line vs bulk access of the four motor direction pins, and edge
+    # events delivered per second; FakeChip by default
+    if backend is None:
+        backend = CharDevBackend(FakeChip())
+    chip = getattr(backend, "chip", None)
+    results = {}
+
+    def run(name, func):
+        calls = chip.calls if isinstance(chip, FakeChip) else None
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            for _ in range(100):
+                func()
+            count += 100
+        elapsed = time.perf_counter() - start
+        results[name] = count / elapsed
+        line = "%-14s %10.0f ops/s" % (name, results[name])
+        if calls is not None:
+            line += "  %.1f chip calls/op" % ((chip.calls - calls) / float(count))
+        print(line)
+
+    for pin in pins:
+        backend.setup(pin, OUT)
+    values = [1, 0, 1, 0]
+    run("write per line", lambda: [backend.output(pin, value) for pin, value in zip(pins, values)])
+    lines = backend.request_lines(pins, OUT)
+    run("write bulk", functools.partial(lines.set_values, values))
+    for pin in pins:
+        backend.setup(pin, IN)
+    run("read per line", lambda: [backend.input(pin) for pin in pins])
+    lines = backend.request_lines(pins, IN)
+    run("read bulk", lines.get_values)
+
+    if isinstance(chip, FakeChip):
+        received = []
+        event = threading.Event()
+        total = 10000
+        def callback(pin, timestamp):
+            received.append(timestamp)
+            if len(received) >= total:
+                event.set()
+        backend.add_event_detect(pins[0], BOTH, callback)
+        level = chip.values[pins[0]]
+        start = time.perf_counter()
+        for _ in range(total):
+            level ^= 1
+            chip.set_input(pins[0], level)
+        event.wait(10)
+        results["events"] = len(received) / (time.perf_counter() - start)
+        print("%-14s %10.0f events/s" % ("edge events", results["events"]))
+        backend.remove_event_detect(pins[0])
+    return results
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,24 +1,169 @@
-from smbus import SMBus
+try:
+    from smbus2 import SMBus, i2c_msg
+except ImportError:
+    from smbus import SMBus
+    i2c_msg = None
 from picar_4wd.utils import soft_reset
+from picar_4wd.recovery import RecoveryPolicy
+from picar_4wd.i2c_executor import I2CExecutor
+import threading
 import time
 
+
+class BusManager(object):
+    """Process wide owner of the I2C buses.
+
+    Hands out a single shared SMBus handle per bus number, probes the MCU
+    address once and keeps the shadow copy of the MCU registers, so the
+    timers already configured by a sibling channel are not reprogrammed.
+    The handle is shared by all threads: every transaction holds lock(bus),
+    so another address can not be selected in the middle of it.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buses = {}            # {bus: SMBus}
+        self._bus_locks = {}        # {bus: RLock}
+        self._mcu = {}              # {bus: addr}
+        self._registers = {}        # {(bus, addr): {reg: value}}
+        self._devices = {}          # {(bus, addr): (probe time, present)}
+        self._restore = []          # callbacks rewriting the registers after a reset
+
+    def get(self, bus):
+        with self._lock:
+            if bus not in self._buses:
+                self._buses[bus] = SMBus(bus)
+            return self._buses[bus]
+
+    def lock(self, bus):
+        with self._lock:
+            if bus not in self._bus_locks:
+                self._bus_locks[bus] = threading.RLock()
+            return self._bus_locks[bus]
+
+    def mcu_address(self, bus, probe):
+        # probe() is called only the first time for each bus, without
+        # holding _lock: the transactions take it in lock(), maybe from
+        # the executor thread
+        with self._lock:
+            if bus in self._mcu:
+                return self._mcu[bus]
+        addr = probe()
+        with self._lock:
+            return self._mcu.setdefault(bus, addr)
+
+    def registers(self, bus, addr):
+        with self._lock:
+            return self._registers.setdefault((bus, addr), {})
+
+    def probe(self, bus, addr, ttl=0):
+        # True if a device acks addr; results younger than ttl seconds
+        # are served from the device map without touching the bus
+        now = time.monotonic()
+        with self._lock:
+            cached = self._devices.get((bus, addr))
+        if cached is not None and now - cached[0] < ttl:
+            return cached[1]
+        smbus = self.get(bus)
+        try:
+            # same probe commands used by `i2cdetect -y`: a quick write
+            # could corrupt the eeproms, so read a byte from those ranges
+            with self.lock(bus):
+                if 0x30 <= addr <= 0x37 or 0x50 <= addr <= 0x5F:
+                    smbus.read_byte(addr)
+                else:
+                    smbus.write_quick(addr)
+            present = True
+        except OSError:
+            present = False
+        with self._lock:
+            self._devices[(bus, addr)] = (time.monotonic(), present)
+        return present
+
+    def scan(self, bus, ttl=0):
+        return [addr for addr in range(0x03, 0x78) if self.probe(bus, addr, ttl)]
+
+    def device_map(self, bus):
+        # {addr: (probe time, present)} of the addresses probed so far
+        with self._lock:
+            return dict((addr, value) for (b, addr), value in self._devices.items() if b == bus)
+
+    def invalidate(self):
+        # the MCU lost its registers (soft_reset), forget the shadow copy
+        with self._lock:
+            for registers in self._registers.values():
+                registers.clear()
+
+    def on_restore(self, func):
+        # func() writes again the registers lost by a reset of the MCU
+        with self._lock:
+            self._restore.append(func)
+
+    def restore(self):
+        with self._lock:
+            funcs = list(self._restore)
+        for func in funcs:
+            func()
+
+    def close(self):
+        with self._lock:
+            for smbus in self._buses.values():
+                smbus.close()
+            self._buses.clear()
+            self._mcu.clear()
+            self._registers.clear()
+            self._devices.clear()
+
+
+bus_manager = BusManager()
+
+
+def _reset_mcu():
+    soft_reset()
+    bus_manager.invalidate()
+
+
+recovery_policy = RecoveryPolicy(reset=_reset_mcu, restore=bus_manager.restore)
+
+
+def use_executor(executor):
+    # route the transactions of every I2C object through executor
+    # (an I2CExecutor), None to go back to calling the bus directly
+    I2C.executor = executor
+
+
 class I2C(object):
     MASTER = 0
     SLAVE  = 1
     RETRY = 5
+    SCAN_TTL = 5.0              # seconds a probe result stays valid
+    recovery = recovery_policy  # retry/reset policy of the transactions
+    executor = None             # I2CExecutor serving the transactions, if any
+    PRIORITY = I2CExecutor.NORMAL
 
     def __init__(self, *args, **kargs):    
         self._bus = 1
-        self._smbus = SMBus(self._bus)
+        self._smbus = bus_manager.get(self._bus)
 
     def auto_reset(func):
-        def wrapper(*args, **kw):
-            try:
-                return func(*args, **kw)
-            except OSError:
-                soft_reset()
-                time.sleep(1)
-                return func(*args, **kw)
+        def locked(self, addr, *args, **kw):
+            # the bus lock is held by each attempt, not during the backoff
+            with bus_manager.lock(self._bus):
+                return func(self, addr, *args, **kw)
+        def attempt(self, addr, *args, **kw):
+            # a single try goes to the executor: the backoff and the resets
+            # stay on the calling thread and never hold the bus owner
+            if self.executor is not None:
+                return self.executor.call(self.PRIORITY, locked, self, addr, *args, **kw)
+            return locked(self, addr, *args, **kw)
+        def wrapper(self, addr, *args, **kw):
+            if self.executor is not None and self.executor.in_worker():
+                # nested transaction, the outer call owns the recovery
+                return locked(self, addr, *args, **kw)
+            # one circuit breaker per address and class: the ADC and the PWM
+            # share the MCU address, failing grayscale reads must not block the motors
+            device = (addr, type(self).__name__)
+            return self.recovery.call(device, attempt, self, addr, *args, **kw)
         return wrapper
 
     @auto_reset
@@ -51,26 +196,56 @@ class I2C(object):
         # self._debug("_i2c_read_i2c_block_data: [0x{:02X}] [0x{:02X}] [{}]".format(addr, reg, num))
         return self._smbus.read_i2c_block_data(addr, reg, num)
 
-    def is_ready(self, addr):
-        addresses = self.scan()
-        if addr in addresses:
-            return True
-        else:
-            return False
+    @auto_reset
+    def _i2c_write_read(self, addr, segments):
+        # segments: [(write_list, read_len), ...] -> [read_list, ...]
+        # With smbus2 all the segments go out in a single I2C_RDWR ioctl
+        # (repeated start between messages), otherwise fall back to the
+        # write + single byte reads sequence.
+        if i2c_msg is None:
+            results = []
+            for write, num in segments:
+                if len(write) > 0:
+                    self.send(write, addr)
+                results.append([self._smbus.read_byte(addr) for _ in range(num)])
+            return results
+        msgs = []
+        reads = []
+        for write, num in segments:
+            if len(write) > 0:
+                msgs.append(i2c_msg.write(addr, write))
+            read = i2c_msg.read(addr, num)
+            msgs.append(read)
+            reads.append(read)
+        self._smbus.i2c_rdwr(*msgs)
+        return [list(read) for read in reads]
 
-    def scan(self):                            
-        cmd = "i2cdetect -y %s" % self._bus
-        _, output = self.run_command(cmd)          
-        outputs = output.split('\n')[1:]       
-       # self._debug("outputs")
-        addresses = []
-        for tmp_addresses in outputs:
-            tmp_addresses = tmp_addresses.split(':')[1]
-            tmp_addresses = tmp_addresses.strip().split(' ')    
-            for address in tmp_addresses:
-                if address != '--':
-                    addresses.append(address)
-     #   self._debug("Conneceted i2c device: %s"%addresses)                   
+    @auto_reset
+    def _i2c_write_many(self, addr, writes):
+        # writes: [write_list, ...] to the same device. With smbus2 they all
+        # go out in a single I2C_RDWR ioctl, otherwise one send() each
+        if i2c_msg is None:
+            for write in writes:
+                self.send(write, addr)
+            return
+        self._smbus.i2c_rdwr(*[i2c_msg.write(addr, write) for write in writes])
+
+    def is_ready(self, addr, ttl=None):
+        if ttl is None:
+            ttl = self.SCAN_TTL
+        if self.executor is not None:
+            return self.executor.call(self.PRIORITY, bus_manager.probe, self._bus, addr, ttl)
+        return bus_manager.probe(self._bus, addr, ttl)
+
+    def scan(self, ttl=None):
+        # addresses (int) of the connected devices
+        if ttl is None:
+            ttl = self.SCAN_TTL
+        if self.executor is not None:
+            addresses = self.executor.call(self.PRIORITY, bus_manager.scan, self._bus, ttl)
+        else:
+            addresses = bus_manager.scan(self._bus, ttl)
+     #   self._debug("Conneceted i2c device: %s"%addresses)
         return addresses
 
     def send(self, send, addr, timeout=0):                     
@@ -0,0 +1,102 @@
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class I2CExecutor(object):
+    """Single thread owning the I2C bus.
+
+    Transactions are served from a priority queue, lower priority values
+    first and FIFO within the same priority, so the actuator writes do not
+    wait behind the telemetry reads.
+    """
+    ACTUATOR = 0
+    NORMAL = 1
+    TELEMETRY = 2
+
+    _STOP = float("inf")
+
+    def __init__(self, name="i2c-executor"):
+        self.name = name
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._max_depth = 0
+        self._stats = {}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # pending transactions are served before the thread exits
+        if self._thread is not None:
+            self._queue.put((self._STOP, next(self._seq), None, None, None, None))
+            if not self.in_worker():
+                self._thread.join()
+            self._thread = None
+
+    def running(self):
+        return self._thread is not None
+
+    def in_worker(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, priority, func, *args, **kw):
+        future = Future()
+        self._queue.put((priority, next(self._seq), time.monotonic(), future, func, (args, kw)))
+        with self._lock:
+            self._max_depth = max(self._max_depth, self._queue.qsize())
+            self._priority_stats(priority)["submitted"] += 1
+        return future
+
+    def call(self, priority, func, *args, **kw):
+        # blocking version of submit(); runs func in place when called from
+        # the worker itself (nested transactions) or when not started
+        if self._thread is None or self.in_worker():
+            return func(*args, **kw)
+        return self.submit(priority, func, *args, **kw).result()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            stats = dict((priority, dict(values)) for priority, values in self._stats.items())
+            return {"depth": self._queue.qsize(), "max_depth": self._max_depth, "priorities": stats}
+
+    def _priority_stats(self, priority):
+        if priority not in self._stats:
+            self._stats[priority] = {
+                "submitted": 0,
+                "completed": 0,
+                "wait_total": 0.0,
+                "wait_max": 0.0,
+                "run_total": 0.0,
+            }
+        return self._stats[priority]
+
+    def _run(self):
+        while True:
+            priority, _, queued_at, future, func, params = self._queue.get()
+            if priority == self._STOP:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.monotonic()
+            args, kw = params
+            try:
+                future.set_result(func(*args, **kw))
+            except BaseException as e:
+                future.set_exception(e)
+            end = time.monotonic()
+            with self._lock:
+                stats = self._priority_stats(priority)
+                stats["completed"] += 1
+                stats["wait_total"] += start - queued_at
+                stats["wait_max"] = max(stats["wait_max"], start - queued_at)
+                stats["run_total"] += end - start
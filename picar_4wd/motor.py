@@ -1,20 +1,173 @@
+import math
 import threading
+import time
+from collections import deque
+from picar_4wd.pin import Pin, PinGroup
+from picar_4wd.pwm import write_channels
+from util.periodic import FixedRateLoop
+
+class _Ramp():
+    def __init__(self, power, target, accel, jerk):
+        self.power = float(power)   # current power, float between the ticks
+        self.rate = 0.0             # power/s
+        self.target = target
+        self.accel = accel
+        self.jerk = jerk
+        self.cancelled = False
+
+    def step(self, dt):
+        # advance by dt, True when the target is reached
+        error = self.target - self.power
+        if error == 0 and self.rate == 0:
+            return True
+        if self.accel is None:
+            self.power = self.target
+            self.rate = 0.0
+            return True
+        sign = 1 if error > 0 else -1
+        if self.jerk is None:
+            self.rate = sign * self.accel
+        else:
+            # fastest rate that can still come down to 0 at the target
+            wanted = sign * min(self.accel, math.sqrt(2 * self.jerk * abs(error)))
+            change = max(-self.jerk * dt, min(self.jerk * dt, wanted - self.rate))
+            self.rate += change
+        step = self.rate * dt
+        if step != 0 and (step > 0) == (error > 0) and abs(step) >= abs(error):
+            self.power = self.target
+            self.rate = 0.0
+            return True
+        self.power += step
+        return False
+
+
+class RampScheduler():
+    # one timer loop for the power ramps of all motors. ramp() returns at once,
+    # a new target for a motor preempts its ramp in progress keeping the
+    # current power and rate. accel and jerk are the defaults of the ramps
+    PERIOD = 0.02       # s
+    ACCEL = 200         # power/s, 0 to 100 in 0.5 s
+    JERK = 2000         # power/s^2
+    NO_JERK = math.inf  # jerk of a trapezoidal ramp, no jerk limit
+
+    def __init__(self, period=PERIOD, accel=ACCEL, jerk=JERK):
+        self.period = period
+        self.accel = accel
+        self.jerk = jerk
+        self._ramps = {}            # {motor: _Ramp}
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._loop = FixedRateLoop(period)
+        self._ticks = 0
+
+    def ramp(self, motor, target, accel=None, jerk=None):
+        if accel is None:
+            accel = self.accel
+        if jerk is None:
+            jerk = self.jerk
+        with self._cond:
+            ramp = self._ramps.get(motor)
+            if ramp is None:
+                ramp = _Ramp(motor.power(), target, accel, jerk)
+                self._ramps[motor] = ramp
+            else:
+                ramp.target = target
+                ramp.accel = accel
+                ramp.jerk = jerk
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="RampScheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def cancel(self, motor):
+        with self._cond:
+            ramp = self._ramps.pop(motor, None)
+            if ramp is not None:
+                ramp.cancelled = True
+                self._cond.notify_all()
+
+    def set_power(self, motor, power):
+        # immediate power, stops the ramp of the motor
+        with self._write_lock:
+            self.cancel(motor)
+            motor._set_power(power)
+
+    def busy(self, motor=None):
+        with self._cond:
+            return motor in self._ramps if motor is not None else bool(self._ramps)
+
+    def wait(self, motors=None, timeout=None):
+        # block until the ramps of motors (all if None) are done; False on timeout
+        with self._cond:
+            if motors is None:
+                return self._cond.wait_for(lambda: not self._ramps, timeout)
+            return self._cond.wait_for(lambda: not any(m in self._ramps for m in motors), timeout)
+
+    def stats(self):
+        return {"ticks": self._ticks, "overruns": self._loop.get_stats()["overruns"], "ramps": len(self._ramps)}
+
+    def _run(self):
+        self._loop.run(self._tick, idle=self._idle)
+
+    def _idle(self):
+        # sleep while there is no ramp, True if it did
+        with self._cond:
+            if self._ramps:
+                return False
+            self._cond.wait_for(lambda: self._ramps)
+            return True
+
+    def _tick(self, dt):
+        updates = []
+        with self._cond:
+            for motor, ramp in list(self._ramps.items()):
+                updates.append((motor, ramp, int(round(ramp.power)) if not ramp.step(dt) else ramp.target))
+            self._ticks += 1
+        # the bus writes are done outside _cond, so ramp() never waits for them
+        with self._write_lock:
+            for motor, ramp, power in updates:
+                if ramp.cancelled:
+                    # preempted by set_power() meanwhile
+                    continue
+                if motor.power() != power:
+                    motor._set_power(power)
+        with self._cond:
+            # done only after the last write, unless a new target came meanwhile
+            for motor, ramp, power in updates:
+                if self._ramps.get(motor) is ramp and ramp.power == ramp.target and ramp.rate == 0:
+                    del self._ramps[motor]
+            self._cond.notify_all()
+
+ramp_scheduler = RampScheduler()
 
 class Motor():
-    STEP = 10
-    DELAY = 0.1
     def __init__(self, pwm_pin, dir_pin, is_reversed=False):
         self.pwm_pin = pwm_pin
         self.dir_pin = dir_pin
         self._is_reversed = is_reversed
         self._power = 0
-        self._except_power = 0
-    
-    # def start_timer(self):
-    #     self.t = threading.Timer(self.DELAY, self.adder_thread)
-    #     self.t.start()
+
+    def power(self):
+        # last power set, -100 ~ 100
+        return self._power
 
     def set_power(self, power):
+        # jump to power now, stops a ramp in progress
+        ramp_scheduler.set_power(self, power)
+
+    def ramp(self, power, accel=None, jerk=None):
+        # reach power with limited acceleration (power/s) and jerk (power/s^2),
+        # returns at once; None for the RampScheduler defaults, jerk
+        # RampScheduler.NO_JERK for no jerk limit
+        ramp_scheduler.ramp(self, power, accel, jerk)
+
+    def wait(self, timeout=None):
+        # block until the ramp of this motor is done
+        return ramp_scheduler.wait([self], timeout)
+
+    def _command(self, power):
+        # (direction pin value, pulse width percent) for power
         if power >= 0:
             direction = 0
         elif power < 0:
@@ -22,34 +175,58 @@ class Motor():
         power = abs(power)
         if power != 0:
             power = int(power /2 ) + 50
-        power = power
+        direction = direction if not self._is_reversed else int(not direction)
+        return direction, power
 
-        direction = direction if not self._is_reversed else not direction  
+    def _set_power(self, power):
+        self._power = power
+        direction, power = self._command(power)
         self.dir_pin.value(direction)
-            
         self.pwm_pin.pulse_width_percent(power)
 
-#     def adder_thread(self):
-#         if self._except_power > self._power:
-#             step = self.STEP
-#         else:
-#             step = -self.STEP
-#         if abs(self._except_power - self._power) < self.STEP:
-#             self._power = self._except_power
-#         else:
-#             self._power += step
-#         self._set_power(self._power)
-#         if self._power != self._except_power:
-#             self.start_timer()
-
-#     def set_power(self, power):
-#         # print("Power: {}".format(power))
-#         self._except_power = power
-#         if self._power != self._except_power:
-#             self.start_timer()
-
-# if __name__ == "__main__":
-#     import picar-4wd as fc
-#     import time
-#     fc.forward(100)
-#     time.sleep(1)
+
+class DriveGroup():
+    # motors commanded together: all the direction pins are written first
+    # (one PinGroup write), then all the PWM channels in a single I2C
+    # transaction. skew() is the time between the first and the last wheel
+    # update of each command
+    SKEWS = 100
+
+    def __init__(self, motors):
+        self.motors = list(motors)
+        self._dirs = PinGroup([motor.dir_pin for motor in self.motors], Pin.OUT)
+        self._pwms = [motor.pwm_pin for motor in self.motors]
+        self._skews = deque(maxlen=self.SKEWS)
+
+    def set_power(self, *powers, sequential=False):
+        # one power per motor, or one for all of them; sequential=True
+        # updates the motors one after the other like Motor.set_power
+        if len(powers) == 1:
+            powers = powers * len(self.motors)
+        with ramp_scheduler._write_lock:
+            for motor in self.motors:
+                ramp_scheduler.cancel(motor)
+            start = time.perf_counter()
+            if sequential:
+                for motor, power in zip(self.motors, powers):
+                    motor._set_power(power)
+            else:
+                commands = [motor._command(power) for motor, power in zip(self.motors, powers)]
+                self._dirs.values([direction for direction, _ in commands])
+                write_channels(self._pwms, [percent for _, percent in commands])
+                for motor, power in zip(self.motors, powers):
+                    motor._power = power
+            self._skews.append(time.perf_counter() - start)
+
+    def powers(self):
+        return [motor.power() for motor in self.motors]
+
+    def skew(self):
+        # seconds between the first and the last wheel update, last SKEWS commands
+        skews = list(self._skews)
+        if not skews:
+            return {"count": 0, "last": 0.0, "avg": 0.0, "max": 0.0}
+        return {"count": len(skews), "last": skews[-1], "avg": sum(skews) / len(skews), "max": max(skews)}
+
+    def reset_skew(self):
+        self._skews.clear()
@@ -0,0 +1,111 @@
+import math
+import threading
+import time
+from collections import deque
+
+
+def compass_heading(compass):
+    # heading source for Odometry from a util.compass.Compass: Compass.heading
+    # is the angle of the field in the car frame, it decreases when the car
+    # turns counterclockwise
+    return lambda: -compass.heading()
+
+
+class Odometry():
+    """Dead-reckoning 2D pose (x, y in cm, theta in rad) from the wheel encoders.
+
+    The encoders only count edges, the direction of each side comes from the
+    power last set on its Motor. With a heading source theta follows it
+    instead of the encoder difference; for a Compass use compass_heading().
+    """
+    TRACK_WIDTH = 14.0      # cm, effective distance between left and right wheels
+
+    def __init__(self, left, right, left_motor=None, right_motor=None, heading=None,
+                 rate=50, history=500, track_width=TRACK_WIDTH):
+        # left, right: Speed or list of Speed of each side
+        # heading: callable returning the heading in rad, growing counterclockwise
+        self.left = left if isinstance(left, (list, tuple)) else [left]
+        self.right = right if isinstance(right, (list, tuple)) else [right]
+        self.left_motor = left_motor
+        self.right_motor = right_motor
+        self.heading = heading
+        self.period = 1.0 / rate
+        self.track_width = track_width
+        self._history = deque(maxlen=history)
+        self._thread = None
+        self._running = False
+        self.reset()
+
+    def reset(self, x=0.0, y=0.0, theta=0.0):
+        self._ticks = (self._side_ticks(self.left), self._side_ticks(self.right))
+        self._heading_offset = None
+        if self.heading is not None:
+            self._heading_offset = self.heading() - theta
+        self._distance = 0.0
+        self._pose = (time.monotonic(), x, y, theta)
+        self._history.clear()
+        self._history.append(self._pose)
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="Odometry", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while self._running:
+            self.update()
+            time.sleep(self.period)
+
+    def _side_ticks(self, speeds):
+        return sum(speed.ticks() for speed in speeds) / float(len(speeds))
+
+    def _side_distance(self, ticks, last, speeds, motor):
+        distance = (ticks - last) / speeds[0].EDGES_PER_REV * speeds[0].WHEEL_PERIMETER
+        if motor is not None and motor.power() < 0:
+            distance = -distance
+        return distance
+
+    def update(self):
+        # integrate the ticks counted since the last update
+        left = self._side_ticks(self.left)
+        right = self._side_ticks(self.right)
+        dl = self._side_distance(left, self._ticks[0], self.left, self.left_motor)
+        dr = self._side_distance(right, self._ticks[1], self.right, self.right_motor)
+        self._ticks = (left, right)
+        _, x, y, theta = self._pose
+        d = (dl + dr) / 2.0
+        if self.heading is not None:
+            new_theta = self.heading() - self._heading_offset
+            new_theta = math.atan2(math.sin(new_theta), math.cos(new_theta))
+        else:
+            new_theta = theta + (dr - dl) / self.track_width
+        # midpoint heading of the step
+        delta = math.atan2(math.sin(new_theta - theta), math.cos(new_theta - theta))
+        middle = theta + delta / 2.0
+        x += d * math.cos(middle)
+        y += d * math.sin(middle)
+        theta = math.atan2(math.sin(new_theta), math.cos(new_theta))
+        self._distance += abs(d)
+        # a new tuple each time: readers never see a half updated pose
+        self._pose = (time.monotonic(), x, y, theta)
+        self._history.append(self._pose)
+        return self._pose
+
+    def pose(self):
+        # (timestamp, x, y, theta) of the last update
+        return self._pose
+
+    def history(self):
+        # last poses, oldest first
+        return list(self._history)
+
+    def distance(self):
+        # cm travelled since reset(), both directions counted
+        return self._distance
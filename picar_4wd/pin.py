@@ -1,14 +1,26 @@
-import RPi.GPIO as GPIO
+import functools
+import time
+from picar_4wd import gpio
+from picar_4wd.filedb import FileDB
+
+def _default_backend():
+    # config: gpio_backend = 'chardev' (and gpio_chip = '/dev/gpiochip0')
+    # for the GPIO character device, RPi.GPIO otherwise
+    config = FileDB()
+    if config.get('gpio_backend', default_value='rpi') == 'chardev':
+        return gpio.CharDevBackend(config.get('gpio_chip', default_value='/dev/gpiochip0'))
+    return gpio.RPiGPIOBackend()
 
 class Pin(object):
-    OUT = GPIO.OUT                  
-    IN = GPIO.IN                   
-    IRQ_FALLING = GPIO.FALLING      
-    IRQ_RISING = GPIO.RISING        
-    IRQ_RISING_FALLING = GPIO.BOTH  
-    PULL_UP = GPIO.PUD_UP           
-    PULL_DOWN = GPIO.PUD_DOWN       
+    OUT = gpio.OUT                  
+    IN = gpio.IN                   
+    IRQ_FALLING = gpio.FALLING      
+    IRQ_RISING = gpio.RISING        
+    IRQ_RISING_FALLING = gpio.BOTH  
+    PULL_UP = gpio.PUD_UP           
+    PULL_DOWN = gpio.PUD_DOWN       
     PULL_NONE = None                
+    backend = None                  # shared by all pins, see set_backend()
     _dict = {                       
         "D0":  17,
         "D1":  18,
@@ -33,8 +45,9 @@ class Pin(object):
 
     def __init__(self, *value):
         super().__init__()          
-        GPIO.setmode(GPIO.BCM)      
-        GPIO.setwarnings(False)     
+        if Pin.backend is None:
+            # setmode/setwarnings and the chip open happen once, here
+            Pin.backend = _default_backend()
         if len(value) > 0:          
             pin = value[0]
         if len(value) > 1:          
@@ -56,7 +69,9 @@ class Pin(object):
             self._pin = pin
         else:
             self._error('Pin should be in %s, not %s' % (self._dict, pin))
-        self._value = 0
+        self._value = None          # last value written, None if unknown
+        self._writes = 0
+        self._skipped = 0
         self.init(mode, pull=setup)
     #    self._info("Pin init finished.")
         
@@ -64,10 +79,13 @@ class Pin(object):
         self._pull = pull
         self._mode = mode
         if mode != None:
-            if pull != None:
-                GPIO.setup(self._pin, mode, pull_up_down=pull)
-            else:
-                GPIO.setup(self._pin, mode)
+            self.backend.setup(self._pin, mode, pull)
+
+    @staticmethod
+    def set_backend(backend):
+        # gpio.RPiGPIOBackend, gpio.CharDevBackend or compatible; call it
+        # before creating pins, the existing ones keep their lines
+        Pin.backend = backend
 
     def dict(self, *_dict):                 
         if len(_dict) == 0:                 
@@ -85,15 +103,48 @@ class Pin(object):
     def value(self, *value):                 
         if len(value) == 0:
             self.mode(self.IN)
-            result = GPIO.input(self._pin)
+            result = self.backend.input(self._pin)
         #    self._debug("read pin %s: %s" % (self._pin, result))
             return result
         else:                               
             value = value[0]
+            if self._mode == self.OUT and self._value == value:
+                # line already driven to this level
+                self._skipped += 1
+                return value
             self.mode(self.OUT)
-            GPIO.output(self._pin, value)
+            self.backend.output(self._pin, value)
+            self._value = value
+            self._writes += 1
             return value
 
+    def reader(self):
+        # input handle: sets the direction once, each call is a bare backend input.
+        # Get a new handle if value()/mode() switched the pin to output meanwhile
+        self.mode(self.IN)
+        return functools.partial(self.backend.input, self._pin)
+
+    def writer(self):
+        # output handle: sets the direction once, each call is a bare backend output.
+        # Writes through the handle bypass the last value tracking
+        self.mode(self.OUT)
+        self._value = None
+        return functools.partial(self.backend.output, self._pin)
+
+    def flush(self):
+        # drive the last written value again, e.g. after a soft_reset
+        if self._value is not None:
+            value = self._value
+            self._value = None
+            self.value(value)
+
+    def invalidate(self):
+        # forget the last written value, next write always reaches the line
+        self._value = None
+
+    def stats(self):
+        return {"writes": self._writes, "skipped": self._skipped}
+
     def on(self):                           
         return self.value(1)
 
@@ -111,15 +162,28 @@ class Pin(object):
             return self._mode
         else:
             mode = value[0]
+            if mode == self._mode:
+                # direction already set, skip the setup
+                return
             self._mode = mode
-            GPIO.setup(self._pin, mode)
+            self.backend.setup(self._pin, mode, self._pull)
 
     def pull(self, *value):     
         return self._pull
 
-    def irq(self, handler=None, trigger=None):      
+    def irq(self, handler=None, trigger=None, timestamped=False):      
+        # handler(channel), or handler(channel, timestamp_ns) if timestamped:
+        # the kernel time of the edge with the chardev backend, the callback
+        # time (time.monotonic_ns) with RPi.GPIO
+        if handler is None:
+            self.backend.remove_event_detect(self._pin)
+            return
         self.mode(self.IN)
-        GPIO.add_event_detect(self._pin, trigger, callback=handler)
+        if timestamped:
+            callback = handler
+        else:
+            callback = lambda channel, timestamp: handler(channel)
+        self.backend.add_event_detect(self._pin, trigger, callback)
 
     def name(self):                                 
         return "GPIO%s"%self._pin
@@ -149,3 +213,54 @@ class Pin(object):
 
         def __init__(self):
             pass
+
+
+class PinGroup(object):
+    # several pins in one line request: values() reads or writes all of them
+    # with one ioctl on the chardev backend, one call per pin on RPi.GPIO
+    def __init__(self, pins, mode):
+        self.pins = [pin if isinstance(pin, Pin) else Pin(pin) for pin in pins]
+        self._mode = mode
+        self._lines = Pin.backend.request_lines([pin._pin for pin in self.pins], mode)
+        for pin in self.pins:
+            # the direction is set, a Pin.mode() would take the line out of the group
+            pin._mode = mode
+            pin._value = None
+
+    def values(self, *values):
+        if len(values) == 0:
+            return self._lines.get_values()
+        values = values[0]
+        if self._mode == Pin.OUT and all(pin._value == value for pin, value in zip(self.pins, values)):
+            for pin in self.pins:
+                pin._skipped += 1
+            return values
+        self._lines.set_values(values)
+        for pin, value in zip(self.pins, values):
+            pin._value = value
+            pin._writes += 1
+        return values
+
+
+def benchmark(pin="D9", seconds=1.0):
+    # polls per second of an input pin: reconfiguring it on every read (the
+    # old Pin.value), with the cached direction and with a reader() handle
+    p = Pin(pin)
+    def setup_and_read():
+        Pin.backend.setup(p._pin, Pin.IN)
+        return Pin.backend.input(p._pin)
+    results = {}
+    for name, poll in [("setup", setup_and_read), ("value", p.value), ("reader", p.reader())]:
+        count = 0
+        start = time.perf_counter()
+        end = start + seconds
+        while time.perf_counter() < end:
+            for _ in range(100):
+                poll()
+            count += 100
+        results[name] = count / (time.perf_counter() - start)
+        print("%-8s %12.0f polls/s" % (name, results[name]))
+    return results
+
+if __name__ == '__main__':
+    benchmark()
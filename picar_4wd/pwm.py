@@ -1,5 +1,7 @@
-import smbus, math
-from picar_4wd.i2c import I2C
+import math
+import weakref
+from picar_4wd.i2c import I2C, bus_manager
+from picar_4wd.i2c_executor import I2CExecutor
 from picar_4wd.pin import Pin
 import time
 
@@ -10,6 +12,11 @@ class PWM(I2C):
     REG_ARR = 0x44
     ADDR = 0x14
     CLOCK = 72000000
+    PRIORITY = I2CExecutor.ACTUATOR
+
+    _writes = 0
+    _skipped = 0
+    _instances = weakref.WeakSet()
 
     def __init__(self, channel):
         super().__init__()
@@ -18,27 +25,69 @@ class PWM(I2C):
                 channel = int(channel[1:])
             else:
                 raise ValueError("PWM channel should be between [P1, P14], not {0}".format(channel))
-        try:
-            self.send(0x2C, self.ADDR)
-            self.send(0, self.ADDR)
-            self.send(0, self.ADDR)
-        except IOError:
-            self.ADDR = 0x15
+        self.ADDR = bus_manager.mcu_address(self._bus, self._probe)
 
       #  self.debug = debug
       #  self._debug("PWM address: {:02X}".format(self.ADDR))
         self.channel = channel
         self.timer = int(channel/4)
-        self.bus = smbus.SMBus(1)
+        self.bus = self._smbus
+        self._shadow = bus_manager.registers(self._bus, self.ADDR)
         self._pulse_width = 0
         self._freq = 50
-        self.freq(50)
+        psc = self._shadow.get(self.REG_PSC + self.timer)
+        arr = self._shadow.get(self.REG_ARR + self.timer)
+        if psc is None or arr is None:
+            self.freq(50)
+        else:
+            # timer already configured by another channel
+            self._prescaler = psc
+            self._arr = arr
+            self._freq = int(round(self.CLOCK / (psc + 1) / (arr + 1)))
+        PWM._instances.add(self)
 
-    def i2c_write(self, reg, value):
+    def _probe(self):
+        try:
+            self.send(0x2C, self.ADDR)
+            self.send(0, self.ADDR)
+            self.send(0, self.ADDR)
+            return self.ADDR
+        except IOError:
+            return 0x15
+
+    def i2c_write(self, reg, value, force=False):
+        if not force and self._shadow.get(reg) == value:
+            # register already holds this value
+            PWM._skipped += 1
+            return
         value_h = value >> 8
         value_l = value & 0xff
     #   self._debug("i2c write: [0x%02X, 0x%02X, 0x%02X, 0x%02X]"%(self.ADDR, reg, value_h, value_l))
         self.send([reg, value_h, value_l], self.ADDR)
+        self._shadow[reg] = value
+        PWM._writes += 1
+
+    def flush(self):
+        # rewrite the registers of this channel, e.g. after a soft_reset
+        self.i2c_write(self.REG_PSC + self.timer, self._prescaler, force=True)
+        self.i2c_write(self.REG_ARR + self.timer, self._arr, force=True)
+        self.i2c_write(self.REG_CHN + self.channel, self._pulse_width, force=True)
+
+    @staticmethod
+    def flush_all():
+        # after a reset of the MCU: the timers and the last pulse width of
+        # every channel, the MCU starts with its default timers
+        for pwm in list(PWM._instances):
+            pwm.flush()
+
+    @staticmethod
+    def invalidate():
+        # forget the shadow copy, next writes always reach the MCU
+        bus_manager.invalidate()
+
+    @staticmethod
+    def stats():
+        return {"writes": PWM._writes, "skipped": PWM._skipped}
 
     def freq(self, *freq):
         if len(freq) == 0:
@@ -103,7 +152,33 @@ class PWM(I2C):
             pulse_width = self._pulse_width_percent * self._arr
             self.pulse_width(pulse_width)
 
-        
+bus_manager.on_restore(PWM.flush_all)
+
+
+def write_channels(pwms, percents):
+    """Set the pulse width percent of several PWM channels with a single bus
+    transaction. Channels already holding their value are not written.
+
+    Returns the number of channels written.
+    """
+    writes = []
+    written = []
+    for pwm, percent in zip(pwms, percents):
+        pwm._pulse_width_percent = percent / 100.0
+        pwm._pulse_width = int(pwm._pulse_width_percent * pwm._arr)
+        reg = PWM.REG_CHN + pwm.channel
+        if pwm._shadow.get(reg) == pwm._pulse_width:
+            PWM._skipped += 1
+            continue
+        writes.append([reg, pwm._pulse_width >> 8, pwm._pulse_width & 0xff])
+        written.append((pwm, reg))
+    if writes:
+        pwms[0]._i2c_write_many(pwms[0].ADDR, writes)
+        for pwm, reg in written:
+            pwm._shadow[reg] = pwm._pulse_width
+            PWM._writes += 1
+    return len(writes)
+
 def test():
     import time
     p = PWM('P12')
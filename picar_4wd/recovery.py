@@ -0,0 +1,200 @@
+import logging
+import threading
+import time
+
+
+class CircuitOpenError(OSError):
+    """Raised without touching the bus while the breaker of a device is open."""
+    pass
+
+
+def _device_name(device):
+    if isinstance(device, tuple):
+        return "0x%02X %s" % device
+    return "0x%02X" % device
+
+
+class CircuitBreaker(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, cooldown=1.0):
+        self.threshold = threshold      # consecutive failed calls before opening
+        self.cooldown = cooldown        # seconds before a trial call is let through
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0
+        self._trial = None              # thread of the half-open trial call
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                # let a single trial call through
+                self.state = self.HALF_OPEN
+                self._trial = threading.get_ident()
+                return True
+            return False
+
+    def abort(self):
+        # the trial call of this thread ended without a verdict (an error
+        # other than OSError): open again, the next call is a new trial
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._trial == threading.get_ident():
+                self.state = self.OPEN
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class RecoveryPolicy(object):
+    """Retry policy for the I2C transactions.
+
+    The first failed transaction of an episode triggers a reset, then
+    `reset_delay` seconds for the MCU to boot and `restore` to rewrite the
+    registers it lost; the callers failing meanwhile wait for it. The
+    episode ends when a device that failed succeeds again, there is no
+    other reset until then. The transactions are retried with a bounded
+    exponential backoff. Every device has its own circuit breaker: after
+    `threshold` failed calls the device is rejected immediately for
+    `cooldown` seconds, so a flaky sensor does not stall the other devices
+    on the bus. A device is an address, or (address, name) for the logical
+    devices sharing one address (the ADC and the PWM of the MCU).
+    """
+
+    def __init__(self, reset=None, restore=None, reset_delay=1.0, retries=4, backoff=0.01,
+                 max_backoff=0.1, threshold=5, cooldown=1.0):
+        self.reset = reset
+        self.restore = restore
+        self.reset_delay = reset_delay
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._breakers = {}
+        self._failing = set()       # devices failed in the current episode
+        self._reset_done = False    # the episode had its reset
+        self._lock = threading.Lock()
+        self._reset_lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {
+            "errors": 0,
+            "retries": 0,
+            "resets": 0,
+            "resets_skipped": 0,
+            "reset_errors": 0,
+            "rejected": 0,
+            "failures": 0,
+            "recoveries": 0,
+            "recovery_time": 0.0,
+            "recovery_time_max": 0.0,
+        }
+
+    def breaker(self, device):
+        with self._lock:
+            if device not in self._breakers:
+                self._breakers[device] = CircuitBreaker(self.threshold, self.cooldown)
+            return self._breakers[device]
+
+    def call(self, device, func, *args, **kw):
+        if getattr(self._local, "active", False):
+            # nested transaction, the outer call owns the recovery
+            return func(*args, **kw)
+        breaker = self.breaker(device)
+        if not breaker.allow():
+            self._count("rejected")
+            raise CircuitOpenError("I2C device %s disabled after repeated errors" % _device_name(device))
+        self._local.active = True
+        try:
+            return self._call(device, breaker, func, *args, **kw)
+        except BaseException:
+            breaker.abort()
+            raise
+        finally:
+            self._local.active = False
+
+    def _call(self, device, breaker, func, *args, **kw):
+        start = None
+        attempt = 0
+        reset = False
+        while True:
+            try:
+                result = func(*args, **kw)
+            except OSError:
+                self._count("errors")
+                if attempt >= self.retries:
+                    self._count("failures")
+                    breaker.failure()
+                    raise
+                if start is None:
+                    start = time.monotonic()
+                if reset or not self._reset(device):
+                    time.sleep(min(self.max_backoff, self.backoff * 2 ** attempt))
+                reset = True
+                attempt += 1
+                self._count("retries")
+                continue
+            breaker.success()
+            if self._failing:
+                self._recovered(device)
+            if start is not None:
+                elapsed = time.monotonic() - start
+                with self._lock:
+                    self._stats["recoveries"] += 1
+                    self._stats["recovery_time"] += elapsed
+                    self._stats["recovery_time_max"] = max(self._stats["recovery_time_max"], elapsed)
+            return result
+
+    def _reset(self, device):
+        # True if this caller reset the device, the MCU had time to boot and
+        # the retry can go at once. Callers failing during a reset block
+        # here until it is over, then skip their own
+        with self._reset_lock:
+            with self._lock:
+                self._failing.add(device)
+            if self._reset_done or self.reset is None:
+                self._count("resets_skipped")
+                return False
+            try:
+                self.reset()
+                self._count("resets")
+                time.sleep(self.reset_delay)
+                if self.restore is not None:
+                    self.restore()
+            except OSError as e:
+                # the next failing call tries again
+                self._count("reset_errors")
+                logging.warning("I2C reset failed: %s", e)
+                return False
+            self._reset_done = True
+            return True
+
+    def _recovered(self, device):
+        with self._lock:
+            if device in self._failing:
+                # end of the episode
+                self._failing.clear()
+                self._reset_done = False
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["breakers"] = dict((device, breaker.state) for device, breaker in self._breakers.items())
+        return stats
@@ -0,0 +1,163 @@
+import threading
+import time
+import numpy as np
+
+class Sweep():
+    # one sweep in angle order: preallocated, filled in place
+    def __init__(self, angles):
+        n = len(angles)
+        self.angle = np.array(angles, dtype=np.int16)
+        self.distance = np.full(n, np.nan)          # cm, -1 no echo, -2 out of range
+        self.status = np.zeros(n, dtype=np.int8)    # 0 near, 1 in between, 2 clear (get_status_at)
+        self.timestamp = np.zeros(n)                # time.monotonic of each reading
+        self.seq = 0                                # number of the sweep, 0 while being filled
+
+    def copy(self):
+        sweep = Sweep.__new__(Sweep)
+        sweep.angle = self.angle
+        sweep.distance = self.distance.copy()
+        sweep.status = self.status.copy()
+        sweep.timestamp = self.timestamp.copy()
+        sweep.seq = self.seq
+        return sweep
+
+
+class Scanner():
+    """Ultrasonic sweeps back and forth over fixed angles.
+
+    Three Sweep buffers, allocated once: step() fills one, one holds the
+    last completed sweep and the third the one before, which is the next to
+    be filled. A buffer gets seq 0 before it is written again (seqlock):
+    snapshot() and the views built on it copy the last sweep and retry if
+    it was reused meanwhile. The endpoint where a sweep turns around is
+    measured once and reused as the first point of the next sweep (with its
+    timestamp).
+    """
+    REF1 = 35
+    REF2 = 10
+
+    def __init__(self, servo, us, angles=range(-90, 91, 18), ref1=REF1, ref2=REF2, reuse_endpoints=True):
+        self.servo = servo
+        self.us = us
+        self.ref1 = ref1
+        self.ref2 = ref2
+        self.reuse_endpoints = reuse_endpoints
+        angles = sorted(set(int(angle) for angle in angles))
+        self._sweeps = [Sweep(angles), Sweep(angles), Sweep(angles)]
+        self._back = 0
+        self._front = None
+        self._spare = 1
+        self._order = list(range(len(angles)))
+        self._pos = 0
+        self._count = 0
+        self._done = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def _status(self, distance):
+        if distance > self.ref1 or distance == -2:
+            return 2
+        elif distance > self.ref2:
+            return 1
+        else:
+            return 0
+
+    def step(self):
+        # one reading into the sweep being filled, True when it completes it
+        back = self._sweeps[self._back]
+        i = self._order[self._pos]
+        self.servo.set_angle(int(back.angle[i]))
+        self.servo.wait()
+        distance = self.us.get_distance()
+        back.distance[i] = distance
+        back.status[i] = self._status(distance)
+        back.timestamp[i] = time.monotonic()
+        self._pos += 1
+        if self._pos < len(self._order):
+            return False
+        with self._done:
+            self._count += 1
+            back.seq = self._count
+            previous = self._front if self._front is not None else 3 - self._back - self._spare
+            self._front = self._back
+            self._back = self._spare
+            self._spare = previous
+            # invalidated before any write, readers of the old sweep notice it
+            self._sweeps[self._back].seq = 0
+            self._done.notify_all()
+        # turn around
+        self._order.reverse()
+        self._pos = 0
+        if self.reuse_endpoints and len(self._order) > 1:
+            nxt = self._sweeps[self._back]
+            nxt.distance[i] = back.distance[i]
+            nxt.status[i] = back.status[i]
+            nxt.timestamp[i] = back.timestamp[i]
+            self._pos = 1
+        return True
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="Scanner", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while self._running:
+            self.step()
+
+    def latest(self):
+        # last completed Sweep, in place: valid while its seq is unchanged,
+        # None before the first one
+        front = self._front
+        return None if front is None else self._sweeps[front]
+
+    def snapshot(self):
+        # copy of the last completed Sweep, never torn; None before the first one
+        while True:
+            sweep = self.latest()
+            if sweep is None:
+                return None
+            seq = sweep.seq
+            copy = sweep.copy()
+            if seq != 0 and sweep.seq == seq:
+                return copy
+
+    def wait(self, seq=0, timeout=None):
+        # block until a sweep newer than seq is completed; its snapshot() or None
+        with self._done:
+            if not self._done.wait_for(lambda: self._count > seq, timeout):
+                return None
+        return self.snapshot()
+
+    def angles(self):
+        return self._sweeps[0].angle
+
+    def distances(self):
+        # raw distances of the last sweep, in angle order (a copy)
+        sweep = self.snapshot()
+        return None if sweep is None else sweep.distance
+
+    def timestamps(self):
+        sweep = self.snapshot()
+        return None if sweep is None else sweep.timestamp
+
+    def status_list(self, ref1=None, ref2=None):
+        # the list scan_step returns, from the last sweep; other thresholds
+        # are computed from its distances without scanning again
+        sweep = self.snapshot()
+        if sweep is None:
+            return []
+        if ref1 is None and ref2 is None:
+            return sweep.status.tolist()
+        ref1 = self.ref1 if ref1 is None else ref1
+        ref2 = self.ref2 if ref2 is None else ref2
+        distance = sweep.distance
+        status = np.where((distance > ref1) | (distance == -2), 2, np.where(distance > ref2, 1, 0))
+        return status.tolist()
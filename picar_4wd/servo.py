@@ -1,4 +1,5 @@
 from picar_4wd.utils import mapping
+import time
 
 class Servo():
     PERIOD = 4095
@@ -8,9 +9,20 @@ class Servo():
     FREQ = 50
     ARR = 4095
     CPU_CLOCK = 72000000
-    def __init__(self, pin, offset=0):
+    SLEW_RATE = 600.0   # deg/s, about 0.1 s/60deg of the SG90
+    DEADTIME = 0.01     # s, one PWM period before it starts plus settling
+    def __init__(self, pin, offset=0, slew_rate=SLEW_RATE, deadtime=DEADTIME):
         self.pin = pin
         self.offset = offset
+        self.slew_rate = slew_rate
+        self.deadtime = deadtime
+        # motion model: last commanded angle, where the move started and when
+        self._angle = None
+        self._from = None
+        self._commanded_at = 0.0
+        self._ready_at = 0.0
+        self._moves = 0
+        self._waited = 0.0
         self.pin.period(self.PERIOD)
         prescaler = int(float(self.CPU_CLOCK) / self.FREQ/ self.ARR)
         self.pin.prescaler(prescaler)
@@ -24,8 +36,74 @@ class Servo():
             angle = -90
         if angle > 90:
             angle = 90
+        now = time.monotonic()
+        start = self.position(now)
+        if angle != self._angle:
+            self._ready_at = now + self.settle_time(angle, start)
+            self._from = start
+            self._angle = angle
+            self._commanded_at = now
+            self._moves += 1
         angle = angle + self.offset
         High_level_time = mapping(angle, -90, 90, self.MIN_PW, self.MAX_PW)
         pwr =  High_level_time / 20000
         value = int(pwr*self.PERIOD)
-        self.pin.pulse_width(value)
\ No newline at end of file
+        self.pin.pulse_width(value)
+
+    def calibrate(self, slew_rate=None, deadtime=None):
+        if slew_rate is not None:
+            self.slew_rate = slew_rate
+        if deadtime is not None:
+            self.deadtime = deadtime
+
+    def angle(self):
+        # last commanded angle, None before the first set_angle
+        return self._angle
+
+    def position(self, now=None):
+        # estimated angle of the horn, None if unknown
+        if now is None:
+            now = time.monotonic()
+        if self._from is None:
+            # first move, from an unknown position
+            return self._angle if now >= self._ready_at else None
+        travelled = max(0.0, now - self._commanded_at - self.deadtime) * self.slew_rate
+        delta = self._angle - self._from
+        if abs(delta) <= travelled:
+            return self._angle
+        return self._from + travelled * (1 if delta > 0 else -1)
+
+    def settle_time(self, angle, start=None):
+        # seconds to reach angle from start (the estimated position by default);
+        # an unknown position counts as the full 180deg travel
+        if start is None:
+            start = self.position()
+        delta = 180 if start is None else abs(angle - start)
+        if delta == 0:
+            return 0.0
+        return self.deadtime + delta / self.slew_rate
+
+    def remaining(self):
+        # seconds until the last commanded angle is reached
+        return max(0.0, self._ready_at - time.monotonic())
+
+    def wait(self):
+        remaining = self.remaining()
+        if remaining > 0:
+            time.sleep(remaining)
+            self._waited += remaining
+        return remaining
+
+    def stats(self):
+        return {"moves": self._moves, "waited": self._waited}
+
+
+def sweep_order(angles, start=None):
+    # visiting order of angles with the least servo travel from start: to the
+    # nearer end first, then straight across to the other one
+    angles = sorted(set(angles))
+    if start is None or not angles:
+        return angles
+    if abs(start - angles[0]) <= abs(start - angles[-1]):
+        return angles
+    return angles[::-1]
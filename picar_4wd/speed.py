@@ -1,43 +1,69 @@
-import RPi.GPIO as GPIO
 import time, math
 import threading
+from collections import deque
+from picar_4wd.pin import Pin
 import picar_4wd as fc
 
 class Speed():
+    EDGES_PER_REV = 40                      # 20 slots, rising and falling edges
+    WHEEL_PERIMETER = 2 * math.pi * 3.3     # cm
+    WINDOW = 0.1                            # s, speed from the edges of the last WINDOW
+    TIMEOUT = 1.0                           # s without edges: wheel stopped
+
     def __init__(self, pin):
-        self.speed_counter = 0
         self.speed = 0
-        self.last_time = 0
         self.pin = pin
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        self.timer_flag = True
-        self.timer = threading.Thread(target=self.fun_timer, name="Thread1")
+        self._pin = Pin(pin, Pin.IN, Pin.PULL_DOWN)
+        self._edges = deque(maxlen=64)      # monotonic ns timestamps of the last edges
+        self._ticks = 0
+        self._lock = threading.Lock()
+        self._running = False
 
     def start(self):
-        self.timer.start()
+        # edges are counted by the GPIO callback thread, no polling thread
+        if not self._running:
+            self._running = True
+            self._pin.irq(self._on_edge, Pin.IRQ_RISING_FALLING, timestamped=True)
         # print('speed start')
 
-    def print_result(self, s):
-        print("Rising: {}; Falling: {}; High Level: {}; Low Level: {}".format(s.count("01"), s.count("10"), s.count("1"), s.count("0")))
+    def _on_edge(self, channel, t):
+        # t: time.monotonic_ns clock, the kernel edge time with the chardev backend
+        with self._lock:
+            self._edges.append(t)
+            self._ticks += 1
+
+    def ticks(self):
+        # edges counted since start(), EDGES_PER_REV per wheel revolution
+        return self._ticks
 
-    def fun_timer(self):
-        while self.timer_flag:
-            l = ""
-            for _ in range(100):
-                l += str(GPIO.input(self.pin))
-                time.sleep(0.001)
-            # self.print_result(l)
-            count = (l.count("01") + l.count("10")) / 2
-            rps = count / 20.0 * 10
-            self.speed = round(2 * math.pi * 3.3 * rps, 2)
+    def edges(self):
+        # timestamps (time.monotonic_ns) of the last edges
+        with self._lock:
+            return list(self._edges)
 
     def __call__(self):
+        # cm/s from the mean period of the edges in the last WINDOW; at low
+        # speed from the last period, decaying while no new edge arrives
+        with self._lock:
+            edges = list(self._edges)
+        now = time.monotonic_ns()
+        if len(edges) < 2 or now - edges[-1] > self.TIMEOUT * 1e9:
+            self.speed = 0
+            return self.speed
+        last = edges[-1]
+        recent = [t for t in edges if t >= last - self.WINDOW * 1e9]
+        if len(recent) < 2:
+            recent = edges[-2:]
+        period = (recent[-1] - recent[0]) / (len(recent) - 1) / 1e9
+        period = max(period, (now - last) / 1e9)
+        rps = 1.0 / (period * self.EDGES_PER_REV)
+        self.speed = round(self.WHEEL_PERIMETER * rps, 2)
         return self.speed
 
     def deinit(self):
-        self.timer_flag = False
-        self.timer.join()
+        if self._running:
+            self._running = False
+            self._pin.irq(None)
 
 
 def test1():
@@ -63,25 +89,25 @@ def test1():
         fc.stop() 
 
 def test2():
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(25, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+    read = Pin(25, Pin.IN, Pin.PULL_DOWN).reader()
     while True:
-        print(GPIO.input(12))
+        print(read())
         time.sleep(0.001) 
 
 def test3():
-    speed4 = Speed(25)
-    speed4.start()
+    fc.start_speed_thread()
+    fc.odometry.reset()
+    fc.odometry.start()
     # time.sleep(2)
     fc.forward(100)
-    x = 0
     for i in range(20):
         time.sleep(0.1)
-        speed = speed4()
-        x += speed * 0.1
-        print("%smm/s"%speed)
-    print("%smm"%x)
-    speed4.deinit()
+        print("%scm/s"%fc.speed_val())
+    print("%scm"%fc.odometry.distance())
+    print(fc.odometry.pose())
+    fc.odometry.stop()
+    fc.left_rear_speed.deinit()
+    fc.right_rear_speed.deinit()
     fc.stop()
 if __name__ == "__main__":
     test3()
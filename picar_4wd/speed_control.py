@@ -0,0 +1,169 @@
+import math
+import threading
+from util.periodic import FixedRateLoop
+
+class PID():
+    def __init__(self, kp, ki, kd, limits=(-100, 100)):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.limits = limits
+        self.reset()
+
+    def reset(self):
+        self._integral = 0.0
+        self._last = None
+
+    def update(self, target, measured, dt):
+        error = target - measured
+        # derivative on the measurement: no kick when the target changes
+        derivative = 0.0
+        if self._last is not None and dt > 0:
+            derivative = -(measured - self._last) / dt
+        self._last = measured
+        low, high = self.limits
+        integral = self._integral + error * dt
+        output = self.kp * error + self.ki * integral + self.kd * derivative
+        if output > high or output < low:
+            # anti-windup: the integral only grows while the output is not
+            # saturated, or when the error pulls it back from the limit
+            if (output > high and error < 0) or (output < low and error > 0):
+                self._integral = integral
+            output = max(low, min(high, self.kp * error + self.ki * self._integral + self.kd * derivative))
+        else:
+            self._integral = integral
+        return output
+
+
+class SpeedController():
+    """Closed loop wheel speed, in the cm/s of Speed, from the encoders.
+
+    Each wheel is a Speed and the motors it drives (the front wheels have no
+    encoder and follow the rear one of the same side). The loop runs in a
+    background thread at a fixed rate; a negative target drives backwards.
+    """
+    RATE = 20               # Hz, Speed averages the edges of the last 0.1 s
+    KP = 1.0
+    KI = 2.0
+    KD = 0.0
+
+    def __init__(self, wheels, rate=RATE, db=None):
+        # wheels: list of (speed, [motor, ...])
+        # db: FileDB with the gains (speed_kp, speed_ki, speed_kd), None for the defaults
+        self.wheels = [(speed, list(motors)) for speed, motors in wheels]
+        self.period = 1.0 / rate
+        self.db = db
+        kp, ki, kd = self.KP, self.KI, self.KD
+        if db is not None:
+            kp = db.get('speed_kp', default_value=kp)
+            ki = db.get('speed_ki', default_value=ki)
+            kd = db.get('speed_kd', default_value=kd)
+        self.pids = [PID(kp, ki, kd) for _ in self.wheels]
+        self._targets = [0.0] * len(self.wheels)
+        self._outputs = [0.0] * len(self.wheels)
+        self._thread = None
+        self._running = False
+        self._loop = FixedRateLoop(self.period)
+        self._stats = None
+        self.reset_stats()
+
+    def gains(self):
+        pid = self.pids[0]
+        return pid.kp, pid.ki, pid.kd
+
+    def set_gains(self, kp, ki, kd, save=False):
+        for pid in self.pids:
+            pid.kp, pid.ki, pid.kd = kp, ki, kd
+        if save:
+            self.save_gains()
+
+    def save_gains(self):
+        if self.db is not None:
+            kp, ki, kd = self.gains()
+            self.db.set('speed_kp', kp)
+            self.db.set('speed_ki', ki)
+            self.db.set('speed_kd', kd)
+
+    def set_target(self, *targets):
+        # one target per wheel, or one for all of them
+        if len(targets) == 1:
+            targets = targets * len(self.wheels)
+        for i, target in enumerate(targets):
+            if target == 0 or (target > 0) != (self._targets[i] > 0):
+                # stopping or reversing: the integral of the old direction is stale
+                self.pids[i].reset()
+            self._targets[i] = float(target)
+
+    def targets(self):
+        return list(self._targets)
+
+    def start(self):
+        # the Speed of each wheel must be started
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="SpeedController", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._targets = [0.0] * len(self.wheels)
+        for pid in self.pids:
+            pid.reset()
+        for _, motors in self.wheels:
+            for motor in motors:
+                motor.set_power(0)
+
+    def _run(self):
+        self._loop.run(self.update, lambda: self._running)
+
+    def update(self, dt):
+        # one step of every wheel, called by the thread
+        stats = self._stats
+        for i, (speed, motors) in enumerate(self.wheels):
+            target = self._targets[i]
+            measured = speed()
+            if target < 0:
+                measured = -measured
+            if target == 0:
+                output = 0
+            else:
+                output = self.pids[i].update(target, measured, dt)
+                # never push against the requested direction, that is braking by reversing
+                output = max(0, output) if target > 0 else min(0, output)
+            self._outputs[i] = output
+            power = int(round(output))
+            for motor in motors:
+                if motor.power() != power:
+                    motor.set_power(power)
+            error = target - measured
+            wheel = stats['wheels'][i]
+            wheel['error'] = error
+            wheel['error_abs_total'] += abs(error)
+            wheel['error_square_total'] += error * error
+            wheel['error_max'] = max(wheel['error_max'], abs(error))
+        stats['updates'] += 1
+
+    def reset_stats(self):
+        self._loop.reset_stats()
+        self._stats = {'updates': 0,
+                       'wheels': [{'error': 0.0, 'error_abs_total': 0.0, 'error_square_total': 0.0,
+                                   'error_max': 0.0} for _ in self.wheels]}
+
+    def stats(self):
+        # loop timing (s) and tracking error (cm/s) of each wheel since reset_stats()
+        stats = dict(self._stats)
+        stats.update(self._loop.get_stats())
+        updates = stats['updates']
+        wheels = []
+        for i, wheel in enumerate(stats['wheels']):
+            wheel = dict(wheel)
+            wheel['target'] = self._targets[i]
+            wheel['power'] = self._outputs[i]
+            wheel['error_mean_abs'] = wheel['error_abs_total'] / updates if updates else 0.0
+            wheel['error_rms'] = math.sqrt(wheel['error_square_total'] / updates) if updates else 0.0
+            wheels.append(wheel)
+        stats['wheels'] = wheels
+        return stats
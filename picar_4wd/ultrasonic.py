@@ -1,7 +1,10 @@
+import logging
 import time
+import threading
 from picar_4wd.servo import Servo
 from picar_4wd.pwm import PWM
 from picar_4wd.pin import Pin
+from util.periodic import FixedRateLoop
 
 class Ultrasonic():
     ANGLE_RANGE = 180
@@ -18,21 +21,30 @@ class Ultrasonic():
         self.max_angle = self.ANGLE_RANGE/2
         self.min_angle = -self.ANGLE_RANGE/2
         self.scan_list = []
+        # edge timestamped measurement (get_distance_irq)
+        self._irq_installed = False
+        self._armed = False
+        self._edges = []
+        self._edges_done = threading.Event()
 
-    def get_distance(self):
+    def _trigger(self):
         self.trig.low()
         time.sleep(0.01)
         self.trig.high()
         time.sleep(0.000015)
         self.trig.low()
+
+    def get_distance(self):
+        self._trigger()
         pulse_end = 0
         pulse_start = 0
+        echo = self.echo.reader()
         timeout_start = time.time()
-        while self.echo.value()==0:
+        while echo()==0:
             pulse_start = time.time()
             if pulse_start - timeout_start > self.timeout:
                 return -1
-        while self.echo.value()==1:
+        while echo()==1:
             pulse_end = time.time()
             if pulse_end - timeout_start > self.timeout:
                 return -2
@@ -41,6 +53,35 @@ class Ultrasonic():
         #print(cm)
         return cm
 
+    def _on_echo(self, channel, t):
+        if not self._armed:
+            return
+        # first edge after the trigger is the rising one, second the falling one
+        self._edges.append(t)
+        if len(self._edges) >= 2:
+            self._armed = False
+            self._edges_done.set()
+
+    def get_distance_irq(self):
+        # same results as get_distance (-1 no echo, -2 echo too long), but the
+        # echo edges are timestamped (monotonic ns, by the kernel with the
+        # chardev backend) and the caller sleeps until both arrived or timeout
+        if not self._irq_installed:
+            self.echo.irq(self._on_echo, Pin.IRQ_RISING_FALLING, timestamped=True)
+            self._irq_installed = True
+        self._edges = []
+        self._edges_done.clear()
+        self._armed = True
+        self._trigger()
+        done = self._edges_done.wait(self.timeout)
+        self._armed = False
+        edges = self._edges
+        if not done:
+            return -1 if len(edges) == 0 else -2
+        during = (edges[1] - edges[0]) / 1e9
+        cm = round(during * 340 / 2 * 100, 2)
+        return cm
+
     # def get_distance_at(self, angle):
     #     self.servo.set_angle(angle)
     #     time.sleep(0.04)
@@ -77,3 +118,151 @@ class Ultrasonic():
     #         return self.scan_list
     #     else:
     #         return False
+
+
+class RangingService():
+    # HC-SR04: at least 60 ms between triggers, or late echoes of the
+    # previous ping are taken for the new one
+    MAX_RATE = 1 / 0.06
+    NO_ECHO = -1
+    OUT_OF_RANGE = -2
+
+    def __init__(self, us, rate=15, size=32, out_of_range=None, use_irq=True):
+        # us: Ultrasonic; out_of_range: distance (cm) used for the -2
+        # readings in the filtered views, None to drop them like -1
+        self.us = us
+        self.period = 1.0 / min(rate, self.MAX_RATE)
+        self.out_of_range = out_of_range
+        self._measure = us.get_distance_irq if use_irq else us.get_distance
+        self._size = size
+        self._distances = [0.0] * size      # ring buffer
+        self._times = [0.0] * size
+        self._index = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._errors = 0
+        self._last_error = None
+        self._loop = FixedRateLoop(self.period)
+
+    def start(self):
+        # the buffer is cleared, readings taken before (e.g. at another servo
+        # angle) are not mixed with the new ones
+        if self._thread is None:
+            with self._lock:
+                self._index = 0
+                self._count = 0
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="RangingService", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        self._loop.run(self._step, lambda: self._running)
+
+    def _step(self, dt):
+        try:
+            distance = self._measure()
+        except Exception as e:
+            # keep ranging: the readings just age, see max_age and last_error()
+            logging.warning("RangingService measurement failed: %s" % e)
+            self._errors += 1
+            self._last_error = e
+            return
+        with self._lock:
+            self._distances[self._index] = distance
+            self._times[self._index] = time.monotonic()
+            self._index = (self._index + 1) % self._size
+            self._count = min(self._count + 1, self._size)
+
+    def errors(self):
+        # failed measurements since creation
+        return self._errors
+
+    def last_error(self):
+        # exception of the last failed measurement, None if none failed
+        return self._last_error
+
+    def readings(self, window=None, max_age=None):
+        # [(timestamp, distance), ...] oldest first, raw values with sentinels
+        with self._lock:
+            count = self._count if window is None else min(window, self._count)
+            start = self._index - count
+            result = [(self._times[i % self._size], self._distances[i % self._size]) for i in range(start, self._index)]
+        if max_age is not None:
+            now = time.monotonic()
+            result = [r for r in result if now - r[0] <= max_age]
+        return result
+
+    def latest(self):
+        readings = self.readings(1)
+        return readings[0] if readings else None
+
+    def _valid(self, window, max_age):
+        readings = self.readings(window, max_age)
+        values = []
+        for _, distance in readings:
+            if distance >= 0:
+                values.append(distance)
+            elif distance == self.OUT_OF_RANGE and self.out_of_range is not None:
+                values.append(self.out_of_range)
+        return readings, sorted(values)
+
+    def median(self, window=None, max_age=None):
+        # None without readings, the last sentinel if no reading is valid
+        readings, values = self._valid(window, max_age)
+        if len(values) == 0:
+            return readings[-1][1] if readings else None
+        middle = len(values) // 2
+        if len(values) % 2 == 1:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2.0
+
+    def trimmed_mean(self, window=None, trim=0.2, max_age=None):
+        # mean of the valid readings without the lowest and highest trim fraction
+        readings, values = self._valid(window, max_age)
+        if len(values) == 0:
+            return readings[-1][1] if readings else None
+        cut = int(len(values) * trim)
+        if cut > 0 and len(values) > 2 * cut:
+            values = values[cut:-cut]
+        return sum(values) / len(values)
+
+def benchmark(us, samples=50, reference=None):
+    # compare get_distance (busy wait) and get_distance_irq (edge timestamps):
+    # mean/stdev of the readings, error against a reference distance in cm
+    # and the CPU time used by the calling thread for each reading
+    import statistics
+    results = {}
+    for name, measure in [("polling", us.get_distance), ("irq", us.get_distance_irq)]:
+        values = []
+        errors = 0
+        cpu = time.thread_time()
+        wall = time.monotonic()
+        for _ in range(samples):
+            value = measure()
+            if value < 0:
+                errors += 1
+            else:
+                values.append(value)
+            time.sleep(0.05)
+        wall = time.monotonic() - wall - samples * 0.05
+        cpu = time.thread_time() - cpu
+        result = {
+            "mean": statistics.mean(values) if values else None,
+            "stdev": statistics.stdev(values) if len(values) > 1 else None,
+            "errors": errors,
+            "cpu_per_reading": cpu / samples,
+            "cpu_load": cpu / wall if wall > 0 else None,
+        }
+        if reference is not None and values:
+            result["mean_error"] = statistics.mean(abs(v - reference) for v in values)
+        results[name] = result
+        print(name, result)
+    return results
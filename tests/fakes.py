@@ -0,0 +1,76 @@
+import sys
+import types
+
+# picar_4wd and i2c open the bus and the GPIO at import: in memory stand-ins
+# for smbus2 and RPi.GPIO, install() them before importing those packages
+log = []
+failing = set()
+fail_next = [0]     # transactions to fail, whatever they are
+
+
+class _Msg(list):
+    def __init__(self, kind, addr, data):
+        super().__init__(data)
+        self.kind = kind
+        self.addr = addr
+
+
+class _i2c_msg(object):
+    @staticmethod
+    def write(addr, data):
+        return _Msg("w", addr, data)
+
+    @staticmethod
+    def read(addr, length):
+        return _Msg("r", addr, [0] * length)
+
+
+class _SMBus(object):
+    def __init__(self, bus):
+        pass
+
+    def _transfer(self, kind, addr, *args):
+        if fail_next[0] > 0:
+            fail_next[0] -= 1
+            raise OSError(121, "Remote I/O error")
+        log.append((kind, addr) + args)
+
+    def write_byte(self, addr, data):
+        self._transfer("write_byte", addr, data)
+
+    def write_byte_data(self, addr, reg, data):
+        self._transfer("write_byte_data", addr, reg, data)
+
+    def write_word_data(self, addr, reg, data):
+        self._transfer("write_word_data", addr, reg, data)
+
+    def write_quick(self, addr):
+        self._transfer("write_quick", addr)
+
+    def read_byte(self, addr):
+        self._transfer("read_byte", addr)
+        return 0
+
+    def i2c_rdwr(self, *msgs):
+        if any(msg.kind == "r" for msg in msgs) and "read" in failing:
+            raise OSError(121, "Remote I/O error")
+        self._transfer("i2c_rdwr", msgs[0].addr, [(msg.kind, list(msg)) for msg in msgs])
+
+    def close(self):
+        pass
+
+
+def install():
+    smbus2 = types.ModuleType("smbus2")
+    smbus2.SMBus = _SMBus
+    smbus2.i2c_msg = _i2c_msg
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.BCM = 11
+    for name in ("setmode", "setwarnings", "setup", "output", "add_event_detect", "remove_event_detect"):
+        setattr(gpio, name, lambda *args, **kw: None)
+    gpio.input = lambda pin: 0
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    sys.modules.setdefault("smbus2", smbus2)
+    sys.modules.setdefault("RPi", rpi)
+    sys.modules.setdefault("RPi.GPIO", gpio)
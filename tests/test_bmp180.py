@@ -0,0 +1,40 @@
+import unittest
+
+import numpy as np
+
+from i2c.bmp180 import BMP180, compensate_batch, compensate_pression, compensate_temperature
+
+
+class TestCompensation(unittest.TestCase):
+
+    def setUp(self):
+        # test_mode: the datasheet coefficients, UT and UP
+        self.sensor = BMP180(None, test_mode=True)
+        self.calibration = self.sensor.get_calibration_data()
+
+    def test_datasheet_example(self):
+        ut = self.sensor.read_raw_temperature()
+        up = self.sensor.read_raw_pression()
+        t, b5 = compensate_temperature(ut, self.calibration)
+        # the datasheet works in integers, 150 tenths of a degree
+        self.assertAlmostEqual(t, 15.0, places=1)
+        self.assertEqual(compensate_pression(up, b5, self.calibration), 69964)
+        temperatures, pressions = compensate_batch([ut], [up], self.calibration)
+        self.assertEqual(temperatures[0], t)
+        self.assertEqual(pressions[0], 69964)
+
+    def test_batch_is_identical_to_the_scalar_path(self):
+        rng = np.random.default_rng(180)
+        for mode in range(4):
+            ut = rng.integers(0, 1 << 16, 5000)
+            up = rng.integers(0, 1 << (16 + mode), 5000)
+            temperatures, pressions = compensate_batch(ut, up, self.calibration, mode)
+            for i in range(len(ut)):
+                t, b5 = compensate_temperature(int(ut[i]), self.calibration)
+                p = compensate_pression(int(up[i]), b5, self.calibration, mode)
+                self.assertEqual(temperatures[i], t, "mode %d, UT %d" % (mode, ut[i]))
+                self.assertEqual(pressions[i], p, "mode %d, UT %d, UP %d" % (mode, ut[i], up[i]))
+
+
+if __name__ == "__main__":
+    unittest.main()
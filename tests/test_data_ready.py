@@ -0,0 +1,77 @@
+import time
+import unittest
+
+import fakes
+
+fakes.install()
+from i2c.lsm303dlhl import DataReadyReader, FakeEdgeSource
+
+
+class _Sensor(object):
+    # read_accelerometer_sample() takes `read_time` seconds, like a slow bus
+    def __init__(self, read_time=0.0):
+        self.read_time = read_time
+        self.reads = 0
+        self.interrupt = None
+
+    def enable_data_ready_interrupt(self, enable=True):
+        self.interrupt = enable
+
+    def read_accelerometer_sample(self):
+        self.reads += 1
+        if self.read_time:
+            time.sleep(self.read_time)
+        return [self.reads, -self.reads, 1000]
+
+    def get_data_rate(self):
+        return 100
+
+
+class TestDataReadyReader(unittest.TestCase):
+
+    def setUp(self):
+        self.sensor = _Sensor()
+        self.pin = FakeEdgeSource()
+        self.reader = DataReadyReader(self.sensor, self.pin, trigger=None)
+        self.reader.start()
+        self.reader.get_samples()
+
+    def tearDown(self):
+        self.reader.stop()
+
+    def test_samples_are_stamped_with_the_edge_time(self):
+        edge = time.monotonic_ns() - 5000000
+        self.pin.edge(timestamp=edge)
+        samples = self.reader.get_samples()
+        self.assertEqual(len(samples), 1)
+        self.assertAlmostEqual(samples[0][0], edge / 1e9, places=6)
+        self.assertEqual(samples[0][1:], (2, -2, 1000))
+
+    def test_latency_counts_from_the_edge(self):
+        # an edge 20 ms old, read in 10 ms
+        self.sensor.read_time = 0.01
+        self.pin.edge(timestamp=time.monotonic_ns() - 20000000)
+        stats = self.reader.get_stats()
+        self.assertEqual(stats['edges'], 2)
+        self.assertGreaterEqual(stats['dispatch_max'], 0.02)
+        self.assertGreaterEqual(stats['latency_max'], 0.03)
+        self.assertLess(stats['dispatch_max'], stats['latency_max'])
+
+    def test_interval_between_edges(self):
+        edge = time.monotonic_ns()
+        for i in range(3):
+            self.pin.edge(timestamp=edge + i * 10000000)
+        times = [sample[0] for sample in self.reader.get_samples()]
+        self.assertAlmostEqual(times[1] - times[0], 0.01, places=6)
+        self.assertAlmostEqual(times[2] - times[1], 0.01, places=6)
+        self.assertAlmostEqual(self.reader.get_stats()['interval_max'], 0.01, places=6)
+
+    def test_no_reads_after_stop(self):
+        self.reader.stop()
+        self.pin.edge()
+        self.assertEqual(self.reader.get_samples(), [])
+        self.assertFalse(self.sensor.interrupt)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+import threading
+import time
+import unittest
+
+import fakes
+from fakes import fail_next, failing, log
+
+fakes.install()
+import picar_4wd as fc
+from picar_4wd.i2c import I2C, BusManager, use_executor
+from picar_4wd.pwm import PWM
+from picar_4wd.i2c_executor import I2CExecutor
+from picar_4wd.recovery import CircuitBreaker, CircuitOpenError, RecoveryPolicy
+
+
+class TestBreakerPerDevice(unittest.TestCase):
+
+    def setUp(self):
+        # no real backoff nor soft reset
+        self.policy = I2C.recovery
+        self.saved = (self.policy.retries, self.policy.backoff, self.policy.reset)
+        self.policy.retries = 0
+        self.policy.backoff = 0
+        self.policy.reset = None
+        self.policy._breakers.clear()
+
+    def tearDown(self):
+        failing.clear()
+        self.policy.retries, self.policy.backoff, self.policy.reset = self.saved
+        self.policy._breakers.clear()
+
+    def test_stop_reaches_the_bus_while_adc_breaker_is_open(self):
+        fc.forward(50)
+        failing.add("read")
+        for _ in range(self.policy.threshold):
+            with self.assertRaises(OSError):
+                fc.get_grayscale_list()
+        with self.assertRaises(CircuitOpenError):
+            fc.get_grayscale_list()
+        del log[:]
+        fc.stop()
+        writes = [entry for entry in log if entry[0] == "i2c_rdwr"]
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(len(writes[0][2]), 4)
+
+
+class TestResetEpisode(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = I2C.recovery
+        self.saved = (self.policy.retries, self.policy.backoff, self.policy.reset, self.policy.reset_delay)
+        self.resets = []
+        self.policy.retries = 4
+        self.policy.backoff = 0
+        self.policy.reset = lambda: self.resets.append(time.monotonic())
+        self.policy.reset_delay = 0
+        self.policy._breakers.clear()
+
+    def tearDown(self):
+        failing.clear()
+        self.policy.retries, self.policy.backoff, self.policy.reset, self.policy.reset_delay = self.saved
+        self.policy._breakers.clear()
+        self.policy._failing.clear()
+        self.policy._reset_done = False
+
+    def test_one_reset_per_failed_call(self):
+        failing.add("read")
+        with self.assertRaises(OSError):
+            fc.get_grayscale_list()
+        self.assertEqual(len(self.resets), 1)
+
+    def test_no_reset_until_the_device_recovers(self):
+        failing.add("read")
+        for _ in range(3):
+            with self.assertRaises(OSError):
+                fc.get_grayscale_list()
+        self.assertEqual(len(self.resets), 1)
+        failing.clear()
+        fc.get_grayscale_list()
+        failing.add("read")
+        with self.assertRaises(OSError):
+            fc.get_grayscale_list()
+        self.assertEqual(len(self.resets), 2)
+
+    def test_retry_waits_for_the_mcu_to_boot(self):
+        self.policy.reset_delay = 0.05
+        attempts = []
+
+        def func():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise OSError(121, "Remote I/O error")
+
+        self.policy.call(0x99, func)
+        self.assertGreaterEqual(attempts[1] - self.resets[0], 0.05)
+
+
+class TestRestoreAfterReset(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = I2C.recovery
+        self.saved = self.policy.reset_delay
+        self.policy.reset_delay = 0
+        self.policy._breakers.clear()
+
+    def tearDown(self):
+        fail_next[0] = 0
+        self.policy.reset_delay = self.saved
+        self.policy._breakers.clear()
+        self.policy._failing.clear()
+        self.policy._reset_done = False
+
+    def test_timers_and_pulse_widths_are_written_again(self):
+        fc.forward(50)
+        del log[:]
+        fail_next[0] = 1
+        fc.get_grayscale_list()
+        self.assertGreater(self.policy.stats()["resets"], 0)
+        written = dict((entry[2], entry[3]) for entry in log if entry[0] == "write_word_data")
+        for motor in (fc.left_front, fc.right_front, fc.left_rear, fc.right_rear):
+            pwm = motor.pwm_pin
+            self.assertIn(PWM.REG_PSC + pwm.timer, written)
+            self.assertIn(PWM.REG_ARR + pwm.timer, written)
+            width = written[PWM.REG_CHN + pwm.channel]
+            self.assertEqual(((width & 0xff) << 8) | (width >> 8), pwm.pulse_width())
+            self.assertNotEqual(pwm.pulse_width(), 0)
+
+
+class TestHalfOpenTrial(unittest.TestCase):
+
+    def test_trial_ended_by_another_error_lets_a_new_trial_through(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.abort()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(breaker.allow())
+
+    def test_policy_aborts_the_trial_on_keyboard_interrupt(self):
+        policy = RecoveryPolicy(threshold=1, cooldown=0)
+
+        def interrupted():
+            raise KeyboardInterrupt
+
+        policy.breaker(0x99).failure()
+        with self.assertRaises(KeyboardInterrupt):
+            policy.call(0x99, interrupted)
+        self.assertEqual(policy.call(0x99, lambda: 42), 42)
+        self.assertEqual(policy.breaker(0x99).state, CircuitBreaker.CLOSED)
+
+
+class TestExecutorBackoff(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = I2C.recovery
+        self.saved = (self.policy.retries, self.policy.backoff, self.policy.reset)
+        self.policy.retries = 2
+        self.policy.backoff = 0.05
+        self.policy.reset = None
+        self.policy._breakers.clear()
+        self.executor = I2CExecutor()
+        self.executor.start()
+        use_executor(self.executor)
+
+    def tearDown(self):
+        use_executor(None)
+        self.executor.stop()
+        failing.clear()
+        self.policy.retries, self.policy.backoff, self.policy.reset = self.saved
+        self.policy._breakers.clear()
+
+    def test_backoff_does_not_hold_the_executor(self):
+        fc.forward(50)
+        failing.add("read")
+        errors = self.policy.stats()["errors"]
+
+        def read():
+            with self.assertRaises(OSError):
+                fc.get_grayscale_list()
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        # the read failed once and is in its backoff
+        while self.policy.stats()["errors"] == errors:
+            time.sleep(0.001)
+        fc.stop()
+        thread.join()
+        actuator = self.executor.stats()["priorities"][I2CExecutor.ACTUATOR]
+        self.assertLess(actuator["wait_max"], self.policy.backoff)
+
+
+class TestBusManager(unittest.TestCase):
+
+    def test_mcu_probe_does_not_hold_the_manager_lock(self):
+        manager = BusManager()
+
+        def probe():
+            # the transaction of the probe, served by another thread
+            thread = threading.Thread(target=manager.lock, args=(1,))
+            thread.start()
+            thread.join(1)
+            self.assertFalse(thread.is_alive())
+            return 0x14
+
+        self.assertEqual(manager.mcu_address(1, probe), 0x14)
+        self.assertEqual(manager.mcu_address(1, None), 0x14)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+import logging
+import math
+import threading
+import time
+
+from util.compass import AccelerometerCache, tilt_compensated_heading
+from util.periodic import FixedRateLoop
+
+
+def euler_to_quaternion(roll, pitch, yaw):
+    """
+    :return: (w, x, y, z) della rotazione ZYX (yaw, pitch, roll)
+    """
+    cr = math.cos(roll / 2)
+    sr = math.sin(roll / 2)
+    cp = math.cos(pitch / 2)
+    sp = math.sin(pitch / 2)
+    cy = math.cos(yaw / 2)
+    sy = math.sin(yaw / 2)
+    return (cr * cp * cy + sr * sp * sy,
+            sr * cp * cy - cr * sp * sy,
+            cr * sp * cy + sr * cp * sy,
+            cr * cp * sy - sr * sp * cy)
+
+
+def quaternion_to_euler(q):
+    """
+    :param q: (w, x, y, z)
+    :return: (roll, pitch, yaw) in radianti
+    """
+    w, x, y, z = q
+    roll = math.atan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = math.asin(max(-1.0, min(1.0, 2 * (w * y - z * x))))
+    yaw = math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return roll, pitch, yaw
+
+
+class OrientationFilter:
+    """
+    Stima dell'assetto (rollio, beccheggio, imbardata) in background da accelerometro e magnetometro
+    dell'LSM303DLHL con un filtro complementare: ad ogni aggiornamento il quaternione stimato si avvicina di
+    una frazione gain a quello misurato.
+
+    I tre angoli seguono la regola della mano destra negli assi del sensore: l'imbardata e' 0 con l'asse x
+    verso il nord magnetico e cresce girando in senso antiorario, cioe' e' l'opposto della rotta di
+    util.compass.Compass.heading().
+
+    Lo stato viene pubblicato in un doppio buffer con numero di sequenza: get_state() non prende lock e non
+    accede al bus, i cicli di controllo possono chiamarlo ad ogni passo.
+    """
+
+    def __init__(self, imu, compass=None, rate=100, gain=0.1):
+        """
+
+        :param imu: LSM303DLHL
+        :param compass: util.compass.Compass per usare la calibrazione del magnetometro, None per i dati grezzi
+        :param rate: frequenza di aggiornamento in Hz
+        :param gain: peso della misura ad ogni aggiornamento (0-1], piu' basso = piu' filtrato
+        """
+        self.__imu = imu
+        self.__compass = compass
+        self.__accelerometer = AccelerometerCache(imu)
+        self.__loop = FixedRateLoop(1.0 / rate)
+        self.__gain = gain
+        self.__q = None
+        # t, roll, pitch, yaw, qw, qx, qy, qz
+        self.__buffers = [[0.0] * 8, [0.0] * 8]
+        self.__front = 0
+        self.__seq = 0
+        self.__thread = None
+        self.__running = False
+        self.__stats = {'updates': 0, 'stale': 0}
+        self.__check_rate(rate)
+
+    def set_rate(self, rate):
+        self.__loop.period = 1.0 / rate
+        self.__check_rate(rate)
+
+    def __check_rate(self, rate):
+        data_rate = self.__imu.get_data_rate()
+        if data_rate is not None and data_rate < rate:
+            # gli aggiornamenti tra due campioni riusano l'ultimo valido dell'accelerometro
+            logging.warning('Accelerometro a ' + str(data_rate) + ' Hz, piu\' lento del filtro a ' + str(rate) + ' Hz')
+
+    def set_gain(self, gain):
+        self.__gain = gain
+
+    def start(self):
+        if self.__thread is None:
+            self.__running = True
+            self.__thread = threading.Thread(target=self.__run, name='OrientationFilter', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        self.__loop.run(lambda dt: self.update(), lambda: self.__running)
+
+    def update(self, acc_data=None, mag_data=None):
+        """
+        Un passo del filtro, chiamato dal thread o direttamente se il filtro non e' avviato
+        :param acc_data: campione dell'accelerometro, None per leggerlo (ultimo valido se non ci sono dati nuovi)
+        :param mag_data: campione del magnetometro, None per leggerlo
+        """
+        if acc_data is None:
+            acc_data, fresh = self.__accelerometer.read()
+            if not fresh:
+                self.__stats['stale'] += 1
+        if mag_data is None:
+            mag_data = self.__imu.get_magnetic_data()
+        ax, ay, az = acc_data
+        roll = math.atan2(ay, az)
+        pitch = math.atan2(-ax, ay * math.sin(roll) + az * math.cos(roll))
+        # la rotta e' l'angolo del campo nel riferimento del sensore e cala quando si gira in senso antiorario:
+        # cambiata di segno e' una rotazione attorno a z con la stessa regola della mano destra di rollio e
+        # beccheggio (come picar_4wd.odometry.compass_heading)
+        if self.__compass is not None:
+            yaw = -self.__compass.heading(mag_data, acc_data)
+        else:
+            yaw = -tilt_compensated_heading(mag_data, acc_data)
+        measured = euler_to_quaternion(roll, pitch, yaw)
+        q = self.__q
+        if q is None:
+            q = measured
+        else:
+            # q e -q sono la stessa rotazione: si interpola verso quella piu' vicina
+            if sum(a * b for a, b in zip(q, measured)) < 0:
+                measured = tuple(-m for m in measured)
+            gain = self.__gain
+            q = tuple(a + gain * (b - a) for a, b in zip(q, measured))
+            norm = math.sqrt(sum(a * a for a in q))
+            q = tuple(a / norm for a in q)
+        self.__q = q
+        self.__publish((time.monotonic(),) + quaternion_to_euler(q) + q)
+        self.__stats['updates'] += 1
+
+    def __publish(self, values):
+        back = 1 - self.__front
+        self.__buffers[back][:] = values
+        self.__front = back
+        self.__seq += 1
+
+    def get_state(self):
+        """
+        Ultimo stato pubblicato, senza lock
+        :return: (timestamp, roll, pitch, yaw, qw, qx, qy, qz), angoli in radianti
+        """
+        while True:
+            seq = self.__seq
+            state = tuple(self.__buffers[self.__front])
+            if seq == self.__seq:
+                return state
+
+    def get_stats(self):
+        """
+        :return: aggiornamenti, ritardi rispetto alla frequenza richiesta, intervallo e durata degli aggiornamenti
+        """
+        stats = dict(self.__stats)
+        stats.update(self.__loop.get_stats())
+        return stats
@@ -0,0 +1,220 @@
+import logging
+import math
+import time
+
+import numpy as np
+
+
+def tilt_compensated_heading(mag_data, acc_data):
+    """
+    Angolo di rotta compensato per rollio e beccheggio.
+    A sensore orizzontale coincide con get_compass(): atan2(y, x)
+    :param mag_data: [x, y, z] del magnetometro (gia' calibrati)
+    :param acc_data: [x, y, z] dell'accelerometro
+    :return: angolo in radianti (-pi, pi]
+    """
+    ax, ay, az = acc_data
+    mx, my, mz = mag_data
+    roll = math.atan2(ay, az)
+    sin_roll = math.sin(roll)
+    cos_roll = math.cos(roll)
+    pitch = math.atan2(-ax, ay * sin_roll + az * cos_roll)
+    sin_pitch = math.sin(pitch)
+    cos_pitch = math.cos(pitch)
+    bx = mx * cos_pitch + my * sin_pitch * sin_roll + mz * sin_pitch * cos_roll
+    by = my * cos_roll - mz * sin_roll
+    return math.atan2(by, bx)
+
+
+def tilt_compensated_headings(mag_data, acc_data, calibration=None):
+    """
+    Versione vettoriale di tilt_compensated_heading() per un intero array registrato
+    :param mag_data: array (n, 3) del magnetometro (grezzi)
+    :param acc_data: array (n, 3) dell'accelerometro
+    :param calibration: CompassCalibration da applicare ai dati del magnetometro, None per nessuna
+    :return: array (n,) di angoli in radianti
+    """
+    mag = np.asarray(mag_data, dtype=np.float64)
+    acc = np.asarray(acc_data, dtype=np.float64)
+    if calibration is not None:
+        mag = (mag - np.asarray(calibration.get_offsets())) * np.asarray(calibration.get_scales())
+    roll = np.arctan2(acc[:, 1], acc[:, 2])
+    sin_roll = np.sin(roll)
+    cos_roll = np.cos(roll)
+    pitch = np.arctan2(-acc[:, 0], acc[:, 1] * sin_roll + acc[:, 2] * cos_roll)
+    sin_pitch = np.sin(pitch)
+    cos_pitch = np.cos(pitch)
+    bx = mag[:, 0] * cos_pitch + mag[:, 1] * sin_pitch * sin_roll + mag[:, 2] * sin_pitch * cos_roll
+    by = mag[:, 1] * cos_roll - mag[:, 2] * sin_roll
+    return np.arctan2(by, bx)
+
+
+class CompassCalibration:
+    """
+    Stima incrementale (O(1) per campione) della calibrazione hard/soft iron del magnetometro con il metodo min/max:
+    l'offset di ogni asse e' il centro dell'intervallo osservato (hard iron), la scala riporta gli assi allo stesso
+    raggio medio (soft iron, solo diagonale)
+    """
+    AXES = ['x', 'y', 'z']
+    # ampiezza minima (conteggi) di ogni asse perche' la calibrazione sia considerata valida
+    MIN_RANGE = 100
+
+    def __init__(self):
+        self.__min = [math.inf, math.inf, math.inf]
+        self.__max = [-math.inf, -math.inf, -math.inf]
+        self.__samples = 0
+
+    def update(self, mag_data):
+        """
+        Aggiunge un campione
+        :param mag_data: [x, y, z] grezzi del magnetometro
+        :return: True se il campione ha allargato l'intervallo osservato
+        """
+        changed = False
+        for i in range(3):
+            if mag_data[i] < self.__min[i]:
+                self.__min[i] = mag_data[i]
+                changed = True
+            if mag_data[i] > self.__max[i]:
+                self.__max[i] = mag_data[i]
+                changed = True
+        self.__samples += 1
+        return changed
+
+    def is_valid(self):
+        return all(self.__max[i] - self.__min[i] >= self.MIN_RANGE for i in range(3))
+
+    def get_offsets(self):
+        if not self.is_valid():
+            return [0.0, 0.0, 0.0]
+        return [(self.__max[i] + self.__min[i]) / 2.0 for i in range(3)]
+
+    def get_scales(self):
+        if not self.is_valid():
+            return [1.0, 1.0, 1.0]
+        radius = [(self.__max[i] - self.__min[i]) / 2.0 for i in range(3)]
+        average = sum(radius) / 3.0
+        return [average / r for r in radius]
+
+    def correct(self, mag_data):
+        offsets = self.get_offsets()
+        scales = self.get_scales()
+        return [(mag_data[i] - offsets[i]) * scales[i] for i in range(3)]
+
+    def get_samples(self):
+        return self.__samples
+
+    def save(self, db):
+        """
+        :param db: picar_4wd.filedb.FileDB
+        """
+        for i, axis in enumerate(self.AXES):
+            db.set('compass_min_' + axis, self.__min[i])
+            db.set('compass_max_' + axis, self.__max[i])
+
+    def load(self, db):
+        """
+        :param db: picar_4wd.filedb.FileDB
+        :return: True se nel db c'era una calibrazione
+        """
+        found = True
+        for i, axis in enumerate(self.AXES):
+            low = db.get('compass_min_' + axis)
+            high = db.get('compass_max_' + axis)
+            if low is None or high is None:
+                found = False
+                continue
+            self.__min[i] = min(self.__min[i], low)
+            self.__max[i] = max(self.__max[i], high)
+        return found
+
+
+class AccelerometerCache:
+    """
+    Ultimo campione valido dell'accelerometro: ad ogni lettura vengono sostituiti solo gli assi con un dato nuovo,
+    letture piu' frequenti dell'ODR non azzerano gli assi ancora in conversione
+    """
+
+    def __init__(self, imu):
+        """
+
+        :param imu: LSM303DLHL
+        """
+        self.__imu = imu
+        self.__last = [None, None, None]
+
+    def read(self):
+        """
+        :return: ([x, y, z], True se almeno un asse e' nuovo); 0 per gli assi mai letti
+        """
+        fresh = False
+        for i, value in enumerate(self.__imu.get_accelerometer_update()):
+            if value is not None:
+                self.__last[i] = value
+                fresh = True
+        return [0 if value is None else value for value in self.__last], fresh
+
+
+class Compass:
+    """
+    Bussola compensata per l'inclinazione basata su LSM303DLHL. Ad ogni lettura aggiorna la calibrazione, che viene
+    salvata nel FileDB al piu' ogni save_interval secondi
+    """
+
+    def __init__(self, imu, db=None, calibrate=True, save_interval=10.0):
+        """
+
+        :param imu: LSM303DLHL
+        :param db: picar_4wd.filedb.FileDB dove leggere/salvare la calibrazione, None per non salvarla
+        :param calibrate: aggiorna la calibrazione durante le letture
+        :param save_interval: secondi minimi tra due salvataggi
+        """
+        self.__imu = imu
+        self.__db = db
+        self.__calibrate = calibrate
+        self.__save_interval = save_interval
+        self.__calibration = CompassCalibration()
+        self.__accelerometer = AccelerometerCache(imu)
+        self.__pending = False
+        self.__saved_at = time.monotonic()
+        if db is not None:
+            self.__calibration.load(db)
+
+    def get_calibration(self):
+        return self.__calibration
+
+    def set_calibrate(self, calibrate):
+        self.__calibrate = calibrate
+
+    def heading(self, mag_data=None, acc_data=None):
+        """
+        Angolo di rotta compensato
+        :param mag_data: campione del magnetometro, None per leggerlo dal sensore
+        :param acc_data: campione dell'accelerometro, None per l'ultimo valido letto dal sensore
+        :return: angolo in radianti (-pi, pi]
+        """
+        if mag_data is None:
+            mag_data = self.__imu.get_magnetic_data()
+        if acc_data is None:
+            acc_data, _ = self.__accelerometer.read()
+        if self.__calibrate and self.__calibration.update(mag_data):
+            self.__pending = True
+        if self.__pending:
+            self.__autosave()
+        return tilt_compensated_heading(self.__calibration.correct(mag_data), acc_data)
+
+    def save(self):
+        if self.__db is not None:
+            self.__calibration.save(self.__db)
+        self.__pending = False
+        self.__saved_at = time.monotonic()
+
+    def __autosave(self):
+        if self.__db is None or time.monotonic() - self.__saved_at < self.__save_interval:
+            return
+        try:
+            self.save()
+        except OSError as e:
+            # la bussola continua a funzionare anche senza file di configurazione
+            logging.warning('Salvataggio calibrazione bussola fallito: ' + str(e))
+            self.__saved_at = time.monotonic()
@@ -0,0 +1,68 @@
+import time
+
+
+class FixedRateLoop:
+    """
+    Ciclo a frequenza fissa per i thread di controllo: step(dt) ad ogni periodo con scadenze assolute, senza deriva.
+    Un passo in ritardo riparte da adesso invece di recuperare a raffica (overrun). Tiene le statistiche dei tempi
+    di tutti i passi eseguiti.
+    """
+
+    def __init__(self, period):
+        """
+
+        :param period: periodo in secondi, si puo' cambiare mentre il ciclo gira
+        """
+        self.period = period
+        self.__stats = None
+        self.reset_stats()
+
+    def run(self, step, running=None, idle=None):
+        """
+        Esegue il ciclo nel thread chiamante
+        :param step: step(dt), dt secondi dall'inizio del passo precedente (il periodo per il primo)
+        :param running: running() False per uscire, None per non uscire mai
+        :param idle: idle() chiamato prima di ogni passo, True se si e' bloccato in attesa di lavoro: il ciclo
+                     riparte da adesso come se fosse il primo passo
+        """
+        last = None
+        deadline = time.monotonic()
+        while running is None or running():
+            if idle is not None and idle():
+                last = None
+                deadline = time.monotonic()
+            start = time.monotonic()
+            step(self.period if last is None else start - last)
+            end = time.monotonic()
+            stats = self.__stats
+            stats['steps'] += 1
+            stats['update_total'] += end - start
+            stats['update_max'] = max(stats['update_max'], end - start)
+            if last is not None:
+                stats['interval_total'] += start - last
+                stats['interval_max'] = max(stats['interval_max'], start - last)
+                stats['intervals'] += 1
+            last = start
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                stats['overruns'] += 1
+                deadline = time.monotonic()
+
+    def reset_stats(self):
+        self.__stats = {'steps': 0, 'intervals': 0, 'overruns': 0, 'interval_total': 0.0, 'interval_max': 0.0,
+                        'update_total': 0.0, 'update_max': 0.0}
+
+    def get_stats(self):
+        """
+        :return: passi eseguiti, ritardi, intervallo tra i passi e durata dei passi (totale, medio, massimo) in
+                 secondi, frequenza effettiva in Hz
+        """
+        stats = dict(self.__stats)
+        intervals = stats.pop('intervals')
+        stats['interval_avg'] = stats['interval_total'] / intervals if intervals else 0.0
+        stats['update_avg'] = stats['update_total'] / stats['steps'] if stats['steps'] else 0.0
+        stats['rate'] = 1.0 / stats['interval_avg'] if stats['interval_avg'] else 0.0
+        return stats